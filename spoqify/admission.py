@@ -0,0 +1,101 @@
+import math
+
+from spoqify.ratelimit import TokenBucket
+from spoqify.utils import ExpiringCache
+
+
+class Overloaded(Exception):
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Client:
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = 0
+
+
+class Ticket:
+
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        self.client.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.client.in_flight -= 1
+
+
+class AdmissionControl:
+    """Shed load early instead of letting every request queue up.
+
+    A request is refused if its client exceeds their request rate or number
+    of concurrent requests, or if it would start a new job while the queue is
+    full or its estimated wait is too long. Joining a job that is already
+    queued is always cheap and only subject to the per-client limits.
+    """
+
+    def __init__(
+        self,
+        jobs,
+        max_queued=200,
+        max_wait=300,
+        client_concurrency=3,
+        client_rate=.2,
+        client_burst=10,
+    ):
+        self.jobs = jobs
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.client_concurrency = client_concurrency
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.clients = ExpiringCache(maxsize=50000, ttl=3600)
+        self.shed = 0
+
+    def admit(self, ip, key):
+        client = self.clients.get(ip)
+        if client is None:
+            client = Client(self.client_rate, self.client_burst)
+        # Refresh the TTL of clients that are still active
+        self.clients[ip] = client
+        try:
+            if client.in_flight >= self.client_concurrency:
+                raise Overloaded(
+                    "Too many simultaneous requests, please wait for your "
+                    "other playlists to finish",
+                    self.jobs.estimated_wait(1),
+                )
+            if not client.bucket.try_acquire():
+                raise Overloaded(
+                    "Too many requests, please slow down",
+                    client.bucket.wait_time(),
+                )
+            if key not in self.jobs:
+                if len(self.jobs.waiting) >= self.max_queued:
+                    raise Overloaded(
+                        "Spoqify is very busy right now, please try again "
+                        "later",
+                        self.jobs.estimated_wait(),
+                    )
+                if (wait := self.jobs.estimated_wait()) > self.max_wait:
+                    raise Overloaded(
+                        "Spoqify is very busy right now, please try again "
+                        "later",
+                        wait - self.max_wait,
+                    )
+        except Overloaded:
+            self.shed += 1
+            raise
+        return Ticket(client)
+
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'shed': self.shed,
+        }
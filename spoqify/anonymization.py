@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import datetime
 import hashlib
@@ -9,45 +10,103 @@ import time
 import aiohttp
 import pyotp
 
+from spoqify import metrics, upstream
 from spoqify.app import app
-from spoqify.spotify import create_playlist
+from spoqify.spotify import (
+    fill_playlist,
+    release_playlist,
+    reserve_playlist,
+    wait_until_ready,
+)
+from spoqify.utils import RefreshingValue
+
+
+PAGE_SIZE = 50
+
+# Shared by all tasks so that paginating long playlists cannot starve other
+# requests of upstream capacity
+page_fetch_limit = asyncio.Semaphore(app.config['PLAYLIST_PAGE_CONCURRENCY'])
 
 
 class Rejected(Exception):
     pass
 
 
-async def anonymize_playlist(playlist_id, client_id=None, token=None):
-    if client_id is None:
-        client_id, token = await get_token()
-    data = await load_playlist(playlist_id, client_id, token)
-    app.logger.debug(
-        "Found %d tracks for playlist %s",
-        len(data['tracks']), playlist_id)
-    if not data['tracks']:
-        raise Rejected("Unable to retrieve tracks. Probably a daylist?")
-    date_str = datetime.date.today().strftime('%d %B %Y').lstrip('0')
-    description = (
-        f"Anonymized on {date_str} via spoqify.com · Original playlist: "
-        f"{data['url']} · Donate: https://donate.spoqify.com")
-    url = await create_playlist(data['title'], description, data['tracks'])
+async def anonymize_playlist(
+    playlist_id,
+    client_id=None,
+    token=None,
+    refresh=False,
+):
+    # With `refresh`, replace the cached result with a fresh copy. Only peek,
+    # the route already counted the lookup
+    if not refresh and (url := app.results.peek(playlist_id)):
+        app.logger.debug("Using cached result for playlist %s", playlist_id)
+        return url
+    # The target playlist does not depend on the source data, so create it
+    # while we are loading the source playlist
+    reservation = asyncio.create_task(reserve_playlist())
+    try:
+        if client_id is None:
+            with metrics.phase_seconds.time(phase='token'):
+                client_id, token = await get_token()
+        with metrics.phase_seconds.time(phase='load'):
+            data = await load_playlist(playlist_id, client_id, token)
+        app.logger.debug(
+            "Found %d tracks for playlist %s",
+            len(data['tracks']), playlist_id)
+        if not data['tracks']:
+            raise Rejected("Unable to retrieve tracks. Probably a daylist?")
+        date_str = datetime.date.today().strftime('%d %B %Y').lstrip('0')
+        description = (
+            f"Anonymized on {date_str} via spoqify.com · Original playlist: "
+            f"{data['url']} · Donate: https://donate.spoqify.com")
+        with metrics.phase_seconds.time(phase='reserve'):
+            playlist = await reservation
+        url = await fill_playlist(
+            playlist, data['title'], description, data['tracks'])
+        # Don't hand out the URL before Spotify's database has synced
+        with metrics.phase_seconds.time(phase='ready'):
+            await wait_until_ready(playlist, len(data['tracks']))
+    except BaseException:
+        # Nobody got the URL, so the playlist can be used again
+        _discard_reservation(reservation)
+        raise
+    app.results[playlist_id] = url
     return url
 
 
-async def anonymize_from_seed(seed_type, seed_id):
-    client_id, token = await get_token()
-    playlist_id = await get_radio_playlist_id(seed_type, seed_id, token)
-    return await anonymize_playlist(playlist_id, client_id, token)
+def _discard_reservation(reservation):
+    def release(task):
+        if not task.cancelled() and not task.exception():
+            asyncio.ensure_future(release_playlist(task.result()))
+
+    reservation.add_done_callback(release)
 
 
-totp_secret_cache = {}
+async def anonymize_from_seed(seed_type, seed_id, refresh=False):
+    if playlist_id := app.radio_playlists.peek((seed_type, seed_id)):
+        app.logger.debug(
+            "Using cached radio playlist for %s %s", seed_type, seed_id)
+        return await anonymize_playlist(playlist_id, refresh=refresh)
+    with metrics.phase_seconds.time(phase='token'):
+        client_id, token = await get_token()
+    with metrics.phase_seconds.time(phase='radio'):
+        playlist_id = await get_radio_playlist_id(seed_type, seed_id, token)
+    app.radio_playlists[(seed_type, seed_id)] = playlist_id
+    return await anonymize_playlist(
+        playlist_id, client_id, token, refresh=refresh)
 
 
 async def _update_totp_secret():
     app.logger.debug("Updating TOTP secret")
-    resp = await app.session.get(os.getenv('TOTP_SECRET_SERVICE_URL'))
+    resp = await upstream.request(
+        'web-player', 'GET', os.getenv('TOTP_SECRET_SERVICE_URL'))
     data = await resp.json()
-    totp_secret_cache.update(data)
+    # Keep it in the state backend so it survives restarts
+    expires = data.get('timestamp', time.time()) + 43200
+    app.state.set_value('totp-secret', data, expires)
+    return data
 
 
 def _generate_totp(secret):
@@ -60,12 +119,13 @@ def _generate_totp(secret):
     )
 
 
-async def get_token():
-    age = time.time() - totp_secret_cache.get('timestamp', 0)
-    if age > 43200:
-        await _update_totp_secret()
-    totp = _generate_totp(totp_secret_cache['secret_base32'])
-    resp = await app.session.get(
+async def _fetch_token():
+    if (secret := app.state.get_value('totp-secret')) is None:
+        secret = await _update_totp_secret()
+    totp = _generate_totp(secret['secret_base32'])
+    resp = await upstream.request(
+        'web-token',
+        'GET',
         'https://open.spotify.com/api/token',
         headers={
             'Accept': 'application/json',
@@ -76,7 +136,7 @@ async def get_token():
             'productType': 'web-player',
             'totp': totp,
             'totpServer': totp,
-            'totpVer': totp_secret_cache['version'],
+            'totpVer': secret['version'],
         },
         allow_redirects=False,
     )
@@ -84,18 +144,40 @@ async def get_token():
         data = await resp.json()
         client_id = data['clientId']
         token = data['accessToken']
-    return client_id, token
+        expires = data.get('accessTokenExpirationTimestampMs', 0) / 1000
+    return (client_id, token), expires
+
+
+token_cache = RefreshingValue(
+    lambda: app.state.fetch_shared('web-token', _fetch_token))
+
+
+async def get_token():
+    return await token_cache.get()
+
+
+app_config_cache = {}
 
 
-async def get_client_token(client_id, token):
-    url = 'https://open.spotify.com/'
-    resp = await app.session.get(url)
+async def _update_app_config():
+    app.logger.debug("Updating web player config")
+    resp = await upstream.request(
+        'web-player', 'GET', 'https://open.spotify.com/')
     text = await resp.text()
     config_regex = r'id="appServerConfig"[^>]+>([\w=]+)</script>'
     config_raw = base64.b64decode(re.search(config_regex, text).group(1))
     config = json.loads(config_raw.decode())
-    device_id = config['correlationId']
-    resp = await app.session.post(
+    app_config_cache.update(config, timestamp=time.time())
+
+
+async def _fetch_client_token():
+    age = time.time() - app_config_cache.get('timestamp', 0)
+    if age > 43200:
+        await _update_app_config()
+    client_id, _ = await get_token()
+    resp = await upstream.request(
+        'web-token',
+        'POST',
         'https://clienttoken.spotify.com/v1/clienttoken',
         headers={
             'accept': 'application/json',
@@ -106,7 +188,7 @@ async def get_client_token(client_id, token):
                 'client_version': '1.2.72.110.g3c42800a',
                 'js_sdk_data': {
                     'device_brand': 'unknown',
-                    'device_id': device_id,
+                    'device_id': app_config_cache['correlationId'],
                     'device_model': 'unknown',
                     'device_type': 'computer',
                     'os': 'linux',
@@ -116,14 +198,24 @@ async def get_client_token(client_id, token):
         },
     )
     data = await resp.json()
-    return data['granted_token']['token']
+    granted = data['granted_token']
+    expires = time.time() + granted.get('expires_after_seconds', 0)
+    return granted['token'], expires
 
 
-async def load_playlist(playlist_id, client_id, token):
-    app.logger.debug("Loading tracks for playlist %s", playlist_id)
-    client_token = await get_client_token(client_id, token)
+client_token_cache = RefreshingValue(
+    lambda: app.state.fetch_shared('client-token', _fetch_client_token))
+
+
+async def get_client_token():
+    return await client_token_cache.get()
+
+
+async def _fetch_playlist_page(playlist_id, token, client_token, offset=0):
     try:
-        resp = await app.session.post(
+        resp = await upstream.request(
+            'pathfinder',
+            'POST',
             'https://api-partner.spotify.com/pathfinder/v2/query',
             headers={
                 'authorization': f'Bearer {token}',
@@ -134,8 +226,8 @@ async def load_playlist(playlist_id, client_id, token):
             json={
                 'variables': {
                     'uri': f'spotify:playlist:{playlist_id}',
-                    'offset': 0,
-                    'limit': 50,
+                    'offset': offset,
+                    'limit': PAGE_SIZE,
                     'enableWatchFeedEntrypoint': False,
                 },
                 'operationName':'fetchPlaylist',
@@ -151,11 +243,40 @@ async def load_playlist(playlist_id, client_id, token):
     except aiohttp.ClientResponseError as e:
         if e.status == 404:
             raise Rejected("Unable to find playlist. It's probably private?")
+        if e.status == 401:
+            # Also drop the tokens we share with other workers and restarts
+            token_cache.invalidate()
+            await app.state.invalidate('web-token')
+            client_token_cache.invalidate()
+            await app.state.invalidate('client-token')
         app.logger.error("Unexpected API error for playlist %s", playlist_id)
         raise ValueError("Unexpected error")
     else:
         data = await resp.json()
-    playlist = data['data']['playlistV2']
+    return data['data']['playlistV2']
+
+
+async def _fetch_remaining_items(playlist_id, token, client_token, total):
+    async def fetch_page(offset):
+        async with page_fetch_limit:
+            playlist = await _fetch_playlist_page(
+                playlist_id, token, client_token, offset)
+        if playlist['__typename'] != 'Playlist':
+            raise ValueError("Playlist changed while loading, please retry")
+        return playlist['content']['items']
+
+    pages = await asyncio.gather(*(
+        fetch_page(offset)
+        for offset in range(PAGE_SIZE, total, PAGE_SIZE)
+    ))
+    return [item for page in pages for item in page]
+
+
+async def load_playlist(playlist_id, client_id, token):
+    app.logger.debug("Loading tracks for playlist %s", playlist_id)
+    with metrics.phase_seconds.time(phase='client_token'):
+        client_token = await get_client_token()
+    playlist = await _fetch_playlist_page(playlist_id, token, client_token)
     if playlist['__typename'] == 'NotFound':
         raise Rejected("Unable to find playlist. It's probably private?")
     if playlist['__typename'] != 'Playlist':
@@ -172,6 +293,13 @@ async def load_playlist(playlist_id, client_id, token):
             "Please try again with a song radio URL!"
         )
     tracks = playlist['content']['items']
+    total = playlist['content'].get('totalCount', len(tracks))
+    if total > PAGE_SIZE:
+        app.logger.debug(
+            "Loading %d more items for playlist %s",
+            total - PAGE_SIZE, playlist_id)
+        tracks += await _fetch_remaining_items(
+            playlist_id, token, client_token, total)
     return {
         'url': playlist['sharingInfo']['shareUrl'].split('?')[0],
         'title': playlist['name'],
@@ -185,7 +313,9 @@ async def load_playlist(playlist_id, client_id, token):
 
 
 async def get_radio_playlist_id(seed_type, seed_id, token):
-    resp = await app.session.get(
+    resp = await upstream.request(
+        'spclient',
+        'GET',
         f'https://spclient.wg.spotify.com/'
         f'inspiredby-mix/v2/seed_to_playlist/spotify:{seed_type}:{seed_id}',
         params={'response-format': 'json'},
@@ -2,11 +2,13 @@ import logging
 import os
 import re
 
-import aiohttp
 import quart
 from quart_cors import cors
 
-from spoqify.utils import RecentCounter
+from spoqify.admission import AdmissionControl
+from spoqify.jobs import JobQueue
+from spoqify.prewarm import Prewarmer
+from spoqify.state import create_state
 
 
 if os.getenv('SENTRY_DSN'):
@@ -23,6 +25,29 @@ app = quart.Quart('spoqify')
 app = cors(app)
 
 app.config['AUTH_FILE_PATH'] = 'data/auth'
+# Additional Spotify accounts to spread playlists across, comma-separated.
+# Each one has to be logged in with `init --account NAME`
+app.config['ACCOUNTS'] = [
+    name.strip()
+    for name in os.getenv('ACCOUNTS', '').split(',')
+    if name.strip()
+]
+# 'persistent' keeps caches, stats and tokens in memory and saves them in
+# the background so they survive restarts, 'sqlite' additionally shares
+# them (and rate limits) between workers, 'memory' doesn't save anything
+app.config['STATE_BACKEND'] = os.getenv('STATE_BACKEND', 'persistent')
+app.config['STATE_PATH'] = 'data/state.sqlite'
+# Maximum number of entries per cache to load on startup
+app.config['STATE_WARMUP'] = int(os.getenv('STATE_WARMUP', 10000))
+app.config['PLAYLIST_POOL_PATH'] = 'data/pool'
+app.config['PLAYLIST_POOL_SIZE'] = int(os.getenv('PLAYLIST_POOL_SIZE', 10))
+app.config['PLAYLIST_REGISTRY_PATH'] = 'data/playlists'
+# Once we own this many playlists, overwrite the least recently used one
+# instead of creating new ones (0 disables recycling)
+app.config['PLAYLIST_RECYCLE_LIMIT'] = int(
+    os.getenv('PLAYLIST_RECYCLE_LIMIT', 0))
+app.config['PLAYLIST_RECYCLE_MIN_AGE'] = int(
+    os.getenv('PLAYLIST_RECYCLE_MIN_AGE', 7 * 86400))
 app.config['USER_AGENT'] = (
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 '
     '(KHTML, like Gecko) Version/17.10 Safari/605.1.1')
@@ -33,6 +58,81 @@ app.config['QUART_CORS_ALLOW_ORIGIN'] = [
 app.config['QUART_CORS_EXPOSE_HEADERS'] = ['*']
 app.config['SPOTIFY_CLIENT_ID'] = os.getenv('SPOTIFY_CLIENT_ID')
 app.config['SPOTIFY_CLIENT_SECRET'] = os.getenv('SPOTIFY_CLIENT_SECRET')
+# Upstream request classes: (initial requests per second, burst, initial
+# concurrency). Override e.g. with RATE_LIMIT_API_WRITE=20,40,8
+app.config['RATE_LIMITS'] = {
+    'web-player': (1, 5, 2),
+    'web-token': (2, 5, 2),
+    'pathfinder': (20, 40, 8),
+    'spclient': (10, 20, 4),
+    'accounts': (1, 5, 2),
+    'api-read': (20, 40, 8),
+    'api-write': (15, 30, 8),
+}
+for kind, limits in app.config['RATE_LIMITS'].items():
+    if value := os.getenv(f'RATE_LIMIT_{kind.upper().replace("-", "_")}'):
+        rate, burst, concurrency = value.split(',')
+        app.config['RATE_LIMITS'][kind] = (
+            float(rate), int(burst), int(concurrency))
+# Rates and concurrency may grow up to this many times their initial values
+# while upstream is healthy
+app.config['RATE_LIMIT_GROWTH'] = float(os.getenv('RATE_LIMIT_GROWTH', 4))
+# Connection pool per upstream host: (max connections, keep-alive seconds).
+# Other hosts (e.g. the TOTP secret service) get UPSTREAM_DEFAULT_POOL
+app.config['UPSTREAM_POOLS'] = {
+    'open.spotify.com': (4, 30),
+    'clienttoken.spotify.com': (2, 30),
+    'api-partner.spotify.com': (16, 30),
+    'spclient.wg.spotify.com': (8, 30),
+    'accounts.spotify.com': (2, 30),
+    'api.spotify.com': (16, 30),
+}
+app.config['UPSTREAM_DEFAULT_POOL'] = (4, 15)
+# Give up on upstream requests after this many seconds (including reading the
+# response), so a hung request cannot hold a rate limiter slot forever
+app.config['UPSTREAM_TIMEOUT'] = float(os.getenv('UPSTREAM_TIMEOUT', 30))
+app.config['UPSTREAM_CONNECT_TIMEOUT'] = float(
+    os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5))
+# Send all upstream requests to a stand-in server instead, see spoqify.mock
+app.config['UPSTREAM_URL'] = os.getenv('UPSTREAM_URL')
+app.config['UPSTREAM_DNS_TTL'] = int(os.getenv('UPSTREAM_DNS_TTL', 300))
+# Fail fast for this many seconds after this many consecutive failed requests
+# to an upstream host, see spoqify.circuit.CircuitBreaker
+app.config['CIRCUIT_FAILURES'] = int(os.getenv('CIRCUIT_FAILURES', 5))
+app.config['CIRCUIT_RESET_TIMEOUT'] = float(
+    os.getenv('CIRCUIT_RESET_TIMEOUT', 30))
+app.config['MAX_CONCURRENT_JOBS'] = int(os.getenv('MAX_CONCURRENT_JOBS', 16))
+# Upper bound for waiting on Spotify to list all tracks of a new playlist
+app.config['PLAYLIST_READY_TIMEOUT'] = float(
+    os.getenv('PLAYLIST_READY_TIMEOUT', 5))
+# Admission control, see spoqify.admission.AdmissionControl
+app.config['MAX_QUEUED_JOBS'] = int(os.getenv('MAX_QUEUED_JOBS', 200))
+app.config['MAX_QUEUE_WAIT'] = int(os.getenv('MAX_QUEUE_WAIT', 300))
+app.config['CLIENT_MAX_CONCURRENT'] = int(
+    os.getenv('CLIENT_MAX_CONCURRENT', 3))
+app.config['CLIENT_RATE'] = float(os.getenv('CLIENT_RATE', .2))
+app.config['CLIENT_BURST'] = int(os.getenv('CLIENT_BURST', 10))
+# Number of reverse proxies in front of us that append to X-Forwarded-For
+app.config['PROXY_COUNT'] = int(os.getenv('PROXY_COUNT', 0))
+# Radio playlists change over time, don't hand out stale copies forever
+app.config['RESULT_CACHE_TTL'] = int(os.getenv('RESULT_CACHE_TTL', 86400))
+app.config['RESULT_CACHE_SIZE'] = int(os.getenv('RESULT_CACHE_SIZE', 10000))
+# Seeds map to the same radio playlist for a long time
+app.config['RADIO_CACHE_TTL'] = int(os.getenv('RADIO_CACHE_TTL', 30 * 86400))
+app.config['RADIO_CACHE_SIZE'] = int(os.getenv('RADIO_CACHE_SIZE', 100000))
+# Anonymize the most requested URLs again before their results expire, see
+# spoqify.prewarm.Prewarmer (a top N of 0 disables prewarming)
+app.config['PREWARM_TOP_N'] = int(os.getenv('PREWARM_TOP_N', 100))
+app.config['PREWARM_RATE'] = float(os.getenv('PREWARM_RATE', .1))
+app.config['PREWARM_MARGIN'] = int(os.getenv('PREWARM_MARGIN', 3600))
+app.config['PREWARM_MIN_HITS'] = int(os.getenv('PREWARM_MIN_HITS', 3))
+app.config['PLAYLIST_PAGE_CONCURRENCY'] = int(
+    os.getenv('PLAYLIST_PAGE_CONCURRENCY', 4))
+# Let rejections expire so playlists that turn public can be retried
+app.config['REJECTION_CACHE_TTL'] = int(
+    os.getenv('REJECTION_CACHE_TTL', 21600))
+app.config['REJECTION_CACHE_SIZE'] = int(
+    os.getenv('REJECTION_CACHE_SIZE', 50000))
 
 
 @app.before_serving
@@ -41,15 +141,52 @@ async def startup():
     # Disable some third-party noise
     logging.getLogger('asyncio').setLevel(logging.WARNING)
     logging.getLogger('urllib3').setLevel(logging.WARNING)
-    app.session = aiohttp.ClientSession(raise_for_status=True)
-    app.tasks = {}
-    app.recent_reqs = RecentCounter()
-    app.rejected_urls = {}
+    # One aiohttp session per upstream host, see spoqify.upstream
+    app.sessions = {}
+    app.state = create_state(
+        app.config['STATE_BACKEND'],
+        app.config['STATE_PATH'],
+        warmup=app.config['STATE_WARMUP'],
+    )
+    app.jobs = JobQueue(app.config['MAX_CONCURRENT_JOBS'])
+    app.admission = AdmissionControl(
+        app.jobs,
+        max_queued=app.config['MAX_QUEUED_JOBS'],
+        max_wait=app.config['MAX_QUEUE_WAIT'],
+        client_concurrency=app.config['CLIENT_MAX_CONCURRENT'],
+        client_rate=app.config['CLIENT_RATE'],
+        client_burst=app.config['CLIENT_BURST'],
+    )
+    app.prewarmer = Prewarmer(
+        app.jobs,
+        top_n=app.config['PREWARM_TOP_N'],
+        rate=app.config['PREWARM_RATE'],
+        margin=app.config['PREWARM_MARGIN'],
+        min_hits=app.config['PREWARM_MIN_HITS'],
+    )
+    app.recent_reqs = app.state.counter()
+    app.rejected_urls = app.state.cache(
+        'rejections',
+        maxsize=app.config['REJECTION_CACHE_SIZE'],
+        ttl=app.config['REJECTION_CACHE_TTL'],
+    )
+    app.results = app.state.cache(
+        'results',
+        maxsize=app.config['RESULT_CACHE_SIZE'],
+        ttl=app.config['RESULT_CACHE_TTL'],
+    )
+    app.radio_playlists = app.state.cache(
+        'radio',
+        maxsize=app.config['RADIO_CACHE_SIZE'],
+        ttl=app.config['RADIO_CACHE_TTL'],
+    )
 
 
 @app.after_serving
 async def shutdown():
-    await app.session.close()
+    for pool in app.sessions.values():
+        await pool.close()
+    app.state.close()
 
 
 import spoqify.cli  # noqa
@@ -0,0 +1,95 @@
+import asyncio
+import time
+import uuid
+
+import aiohttp
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_urls(n, kind='track'):
+    return [
+        f'https://open.spotify.com/{kind}/{uuid.uuid4().hex[:22]}'
+        for _ in range(n)
+    ]
+
+
+async def _anonymize(session, target, url):
+    # Read the event stream until we get a result
+    async with session.get(f'{target}/anonymize', params={'url': url}) as r:
+        event = None
+        async for line in r.content:
+            line = line.decode().strip()
+            if line.startswith('event: '):
+                event = line[7:]
+                if event in ('done', 'error'):
+                    return event == 'done'
+    return False
+
+
+async def _redirect(session, target, url):
+    async with session.get(
+        f'{target}/redirect',
+        params={'url': url},
+        allow_redirects=False,
+    ) as r:
+        return r.status == 302
+
+
+async def _upstream_calls(session, mock):
+    if not mock:
+        return None
+    async with session.get(f'{mock}/_stats') as r:
+        return (await r.json())['total']
+
+
+async def run(target, urls, concurrency=10, endpoint='anonymize', mock=None):
+    """Request all `urls` from the Spoqify instance at `target`.
+
+    Returns throughput, latency percentiles and, if the URL of the mock
+    upstream is given, the number of upstream calls per request.
+    """
+    f = _anonymize if endpoint == 'anonymize' else _redirect
+    queue = asyncio.Queue()
+    for url in urls:
+        queue.put_nowait(url)
+    latencies = []
+    failed = 0
+
+    async def worker(session):
+        nonlocal failed
+        while not queue.empty():
+            url = queue.get_nowait()
+            start = time.monotonic()
+            try:
+                ok = await f(session, target, url)
+            except aiohttp.ClientError:
+                ok = False
+            latencies.append(time.monotonic() - start)
+            if not ok:
+                failed += 1
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        calls = await _upstream_calls(session, mock)
+        start = time.monotonic()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.monotonic() - start
+        if calls is not None:
+            calls = await _upstream_calls(session, mock) - calls
+    return {
+        'requests': len(latencies),
+        'failed': failed,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2),
+        'p50': round(_percentile(latencies, 50), 3),
+        'p95': round(_percentile(latencies, 95), 3),
+        'p99': round(_percentile(latencies, 99), 3),
+        'upstream_calls_per_request': (
+            None if calls is None else round(calls / len(latencies), 2)),
+    }
@@ -0,0 +1,77 @@
+import time
+
+from spoqify.admission import Overloaded
+
+
+class CircuitOpen(Overloaded):
+    pass
+
+
+class CircuitBreaker:
+    """Stop sending requests to an upstream that keeps failing.
+
+    After `threshold` consecutive failures (connection errors, timeouts and
+    5xx responses) the circuit opens and requests fail immediately. After
+    `reset_timeout` seconds it turns half-open and lets a single trial
+    request through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        if time.monotonic() - self.opened < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def retry_after(self):
+        if self.opened is None:
+            return 0
+        return self.opened + self.reset_timeout - time.monotonic()
+
+    def check(self):
+        """Raise `CircuitOpen` unless a request may be sent now."""
+        state = self.state
+        if state == 'half-open':
+            # Don't wait forever for a trial request that got cancelled
+            now = time.monotonic()
+            if self.trial is None or now - self.trial > self.reset_timeout:
+                self.trial = now
+                return
+        if state != 'closed':
+            raise self.error()
+
+    def error(self):
+        return CircuitOpen(
+            "Spotify is having trouble right now, please try again later",
+            self.retry_after() or self.reset_timeout,
+        )
+
+    def success(self):
+        self.failures = 0
+        self.opened = self.trial = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or (
+                self.opened is None and self.failures >= self.threshold):
+            self.opened = time.monotonic()
+            self.trial = None
+            self.trips += 1
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'retry_after': max(0, round(self.retry_after())),
+        }
@@ -1,13 +1,14 @@
 import asyncio
 import http.server
-import json
-import os
 from urllib.parse import urlencode
 
 import click
+from aiohttp import web
 
+from spoqify import bench, mock
 from spoqify.app import app, shutdown, startup
-from spoqify.spotify import call_api
+from spoqify.spotify import call_api, get_accounts
+from spoqify.utils import write_json_atomic
 
 
 @click.option(
@@ -16,8 +17,13 @@ from spoqify.spotify import call_api
          "this command on a different machine than your web browser)",
     is_flag=True,
     default=False)
+@click.option(
+    '--account',
+    help="Log in an additional account to spread playlists across, instead "
+         "of the default one",
+    default=None)
 @app.cli.command('init', help="Perform initial Spotify user login")
-def init_token(manual=False):
+def init_token(manual=False, account=None):
     params = {
         'client_id': app.config['SPOTIFY_CLIENT_ID'],
         'response_type': 'code',
@@ -44,9 +50,10 @@ def init_token(manual=False):
                 self.wfile.write(b'All done :)')
         httpd = http.server.HTTPServer(('', 8808), RequestHandler)
         httpd.handle_request()
-    os.makedirs(os.path.dirname(app.config['AUTH_FILE_PATH']), exist_ok=True)
-    with open(app.config['AUTH_FILE_PATH'], 'w') as f:
-        json.dump(data, f)
+    path = app.config['AUTH_FILE_PATH']
+    if account:
+        path += f'.{account}'
+    write_json_atomic(path, data)
 
 
 @click.option(
@@ -58,15 +65,90 @@ def init_token(manual=False):
 def housekeep(check=False):
     async def _housekeep():
         await startup()
-        playlists = await call_api('me/playlists?limit=40&offset=1000')
-        app.logger.info("Total playlists: %d", playlists['total'])
-        if not check:
+        for name, account in get_accounts().items():
+            playlists = await call_api(
+                'me/playlists?limit=40&offset=1000', account=name)
+            app.logger.info(
+                "Total playlists (%s): %d", name, playlists['total'])
+            if check or not playlists['items']:
+                continue
             uris = [p['uri'] for p in playlists['items']]
             await call_api(
                 '/me/library',
                 method='DELETE',
                 params={'uris': ','.join(uris)},
+                account=name,
             )
+            async with account.locked():
+                for p in playlists['items']:
+                    account.registry.pop(p['id'], None)
+                await account.registry.store()
         await shutdown()
 
     asyncio.run(_housekeep())
+
+
+@click.option('--port', default=8900, help="Port to listen on")
+@click.option(
+    '--latency', default=.05, help="Seconds to delay every response")
+@click.option(
+    '--throttle-rate', default=0., help="Share of requests answered with 429")
+@click.option(
+    '--error-rate', default=0., help="Share of requests answered with 503")
+@click.option('--tracks', default=50, help="Number of tracks per playlist")
+@app.cli.command('mock', help="Run a local stand-in for Spotify")
+def run_mock(port, latency, throttle_rate, error_rate, tracks):
+    mock_app = mock.create_app(
+        latency=latency,
+        throttle_rate=throttle_rate,
+        error_rate=error_rate,
+        tracks=tracks,
+    )
+    web.run_app(mock_app, host='127.0.0.1', port=port)
+
+
+@click.option(
+    '--target',
+    default='http://127.0.0.1:5000',
+    help="Spoqify instance to benchmark")
+@click.option(
+    '--mock',
+    'mock_url',
+    default=None,
+    help="URL of the `mock` server, to count upstream calls per request")
+@click.option(
+    '--endpoint',
+    type=click.Choice(['anonymize', 'redirect']),
+    default='anonymize')
+@click.option('--requests', 'n_requests', default=100, type=click.IntRange(1))
+@click.option(
+    '--unique',
+    default=None,
+    type=click.IntRange(1),
+    help="Number of distinct URLs to request (default: all distinct)")
+@click.option('--concurrency', default=10, type=click.IntRange(1))
+@click.option(
+    '--kind',
+    type=click.Choice(['track', 'artist', 'album', 'playlist']),
+    default='track')
+@app.cli.command('bench', help="Benchmark a running Spoqify instance")
+def run_bench(
+    target,
+    mock_url,
+    endpoint,
+    n_requests,
+    unique,
+    concurrency,
+    kind,
+):
+    urls = bench.make_urls(unique or n_requests, kind)
+    urls = [urls[i % len(urls)] for i in range(n_requests)]
+    results = asyncio.run(bench.run(
+        target.rstrip('/'),
+        urls,
+        concurrency=concurrency,
+        endpoint=endpoint,
+        mock=mock_url and mock_url.rstrip('/'),
+    ))
+    for key, value in results.items():
+        print(f"{key}: {value}")
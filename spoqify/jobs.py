@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import itertools
+import time
+
+from spoqify import metrics
+
+
+class Job:
+
+    def __init__(self, key, seq):
+        self.key = key
+        self.seq = seq
+        # Number of jobs waiting for a worker before (and including) this
+        # one, or None once the job has started
+        self.position = None
+        self.task = None
+        self.created = time.monotonic()
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def updates(self, keepalive=30):
+        """Yield the queue position whenever it changes, until done."""
+        last = None
+        # Give a new job the chance to grab a free worker first
+        await asyncio.sleep(0)
+        while not self.task.done():
+            changed = self._changed
+            if self.position is not None and self.position != last:
+                last = self.position
+                yield self.position
+            waiter = asyncio.ensure_future(changed.wait())
+            try:
+                done, _ = await asyncio.wait(
+                    [self.task, waiter],
+                    timeout=keepalive,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                waiter.cancel()
+            if not done:
+                # Keep idle connections from being closed by proxies
+                last = None
+
+
+class JobQueue:
+    """Deduplicated jobs, run with limited concurrency in FIFO order."""
+
+    def __init__(self, concurrency):
+        self.jobs = {}
+        self.waiting = {}
+        self.concurrency = concurrency
+        self.slots = asyncio.Semaphore(concurrency)
+        self.durations = collections.deque(maxlen=100)
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+    def get(self, key):
+        return self.jobs.get(key)
+
+    def add(self, key, f, wait=None, **kwargs):
+        """Queue `f(**kwargs)` as a job for `key`.
+
+        If given, `wait` is awaited before the job takes a slot. If it
+        returns a result, the job is done without running `f`.
+        """
+        job = Job(key, next(self._seq))
+        job.position = len(self.waiting) + 1
+        self.jobs[key] = self.waiting[key] = job
+        job.task = asyncio.create_task(self._run(job, f, wait, kwargs))
+        job.task.add_done_callback(lambda _: self._remove(job))
+        return job
+
+    async def _run(self, job, f, wait, kwargs):
+        # Don't keep a slot busy while waiting on something we can't speed up
+        if wait is not None and (result := await wait()) is not None:
+            self._dequeue(job)
+            return result
+        async with self.slots:
+            self._dequeue(job)
+            start = time.monotonic()
+            metrics.phase_seconds.observe(start - job.created, phase='queue')
+            outcome = 'failed'
+            try:
+                result = await f(**kwargs)
+                outcome = 'done'
+                return result
+            finally:
+                self.durations.append(time.monotonic() - start)
+                metrics.jobs_total.inc(outcome=outcome)
+
+    def _dequeue(self, job):
+        if self.waiting.pop(job.key, None) is not job:
+            return
+        job.position = None
+        job.notify()
+        for other in self.waiting.values():
+            if other.seq > job.seq:
+                other.position -= 1
+                other.notify()
+
+    def _remove(self, job):
+        self._dequeue(job)
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+    def is_idle(self):
+        """Whether there is room for background work besides our jobs."""
+        return (
+            not self.waiting
+            and len(self.jobs) < max(1, self.concurrency // 2)
+        )
+
+    def estimated_wait(self, position=None):
+        """Estimate the seconds until a job at `position` will be done."""
+        if position is None:
+            position = len(self.waiting) + 1
+        if not self.durations:
+            return 0
+        avg = sum(self.durations) / len(self.durations)
+        return avg * (1 + position // self.concurrency)
+
+    def stats(self):
+        return {
+            'jobs': len(self.jobs),
+            'waiting': len(self.waiting),
+            'estimated_wait': round(self.estimated_wait(), 1),
+        }
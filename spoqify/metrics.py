@@ -0,0 +1,136 @@
+import bisect
+import contextlib
+import time
+
+
+# Upper bounds in seconds, from a cached lookup to a large playlist
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value)
+            .replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'),
+        )
+        for key, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if (data := self.values.get(key)) is None:
+            # Per-bucket counts (the last one is +Inf), sum
+            data = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (
+                    f'{self.name}_bucket',
+                    labels + (('le', bound),),
+                    cumulative,
+                )
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+def render():
+    """Return all metrics of this process in Prometheus text format."""
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+phase_seconds = Histogram(
+    'spoqify_phase_seconds',
+    "Time spent in each phase of an anonymization",
+)
+upstream_seconds = Histogram(
+    'spoqify_upstream_request_seconds',
+    "Duration of upstream requests (until the response headers arrived)",
+)
+jobs_total = Counter(
+    'spoqify_jobs_total',
+    "Finished anonymization jobs",
+)
+queue_depth = Gauge(
+    'spoqify_queue_depth',
+    "Jobs waiting for a worker",
+)
+jobs_running = Gauge(
+    'spoqify_jobs_running',
+    "Jobs currently being worked on",
+)
+upstream_in_flight = Gauge(
+    'spoqify_upstream_in_flight',
+    "Upstream requests in flight",
+)
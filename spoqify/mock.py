@@ -0,0 +1,214 @@
+"""Stand-in for the Spotify endpoints we use, for local benchmarking.
+
+Point Spoqify at it with `UPSTREAM_URL=http://127.0.0.1:8900` (requests to
+`https://<host>/<path>` are then sent to `<UPSTREAM_URL>/<host>/<path>`) and
+`TOTP_SECRET_SERVICE_URL=https://totp/secret`.
+"""
+import asyncio
+import base64
+import collections
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+
+def _random_id():
+    return uuid.uuid4().hex[:22]
+
+
+def create_app(
+    latency=.05,
+    jitter=.5,
+    throttle_rate=0,
+    error_rate=0,
+    retry_after=1,
+    tracks=50,
+):
+    """Return the mock upstream as an aiohttp application.
+
+    Every request is delayed by `latency` seconds (randomly varied by
+    `jitter`) and fails with a 429 or 503 at the given rates. Source
+    playlists have `tracks` tracks.
+    """
+    mock = web.Application(middlewares=[_faults])
+    mock['latency'] = latency
+    mock['jitter'] = jitter
+    mock['throttle_rate'] = throttle_rate
+    mock['error_rate'] = error_rate
+    mock['retry_after'] = retry_after
+    mock['tracks'] = tracks
+    mock['calls'] = collections.Counter()
+    mock['playlists'] = {}
+    mock.add_routes([
+        web.get('/_stats', stats),
+        web.get('/totp/secret', totp_secret),
+        web.get('/open.spotify.com/', web_player),
+        web.get('/open.spotify.com/api/token', web_token),
+        web.post('/clienttoken.spotify.com/v1/clienttoken', client_token),
+        web.post('/api-partner.spotify.com/pathfinder/v2/query', pathfinder),
+        web.get(
+            '/spclient.wg.spotify.com/inspiredby-mix/v2/seed_to_playlist/'
+            '{uri}',
+            seed_to_playlist,
+        ),
+        web.post('/accounts.spotify.com/api/token', user_token),
+        web.post('/api.spotify.com/v1/me/playlists', create_playlist),
+        web.put('/api.spotify.com/v1/playlists/{id}', update_playlist),
+        web.get('/api.spotify.com/v1/playlists/{id}/items', get_items),
+        web.put('/api.spotify.com/v1/playlists/{id}/items', replace_items),
+        web.post('/api.spotify.com/v1/playlists/{id}/items', add_items),
+        web.delete('/api.spotify.com/v1/me/library', remove_playlists),
+    ])
+    return mock
+
+
+@web.middleware
+async def _faults(request, handler):
+    mock = request.app
+    if request.path == '/_stats':
+        return await handler(request)
+    mock['calls'][request.path.split('/')[1]] += 1
+    delay = mock['latency'] * random.uniform(
+        1 - mock['jitter'], 1 + mock['jitter'])
+    await asyncio.sleep(delay)
+    roll = random.random()
+    if roll < mock['throttle_rate']:
+        raise web.HTTPTooManyRequests(
+            headers={'Retry-After': str(mock['retry_after'])})
+    if roll < mock['throttle_rate'] + mock['error_rate']:
+        raise web.HTTPServiceUnavailable()
+    return await handler(request)
+
+
+async def stats(request):
+    return web.json_response({
+        'calls': dict(request.app['calls']),
+        'total': sum(request.app['calls'].values()),
+    })
+
+
+async def totp_secret(request):
+    return web.json_response({
+        'secret_base32': 'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ',
+        'version': 1,
+        'timestamp': time.time(),
+    })
+
+
+async def web_player(request):
+    config = base64.b64encode(json.dumps({
+        'correlationId': _random_id(),
+    }).encode()).decode()
+    return web.Response(
+        text=f'<script id="appServerConfig" type="text/plain">{config}'
+             f'</script>',
+        content_type='text/html',
+    )
+
+
+async def web_token(request):
+    return web.json_response({
+        'clientId': 'mockclient',
+        'accessToken': _random_id(),
+        'accessTokenExpirationTimestampMs': (time.time() + 3600) * 1000,
+    })
+
+
+async def client_token(request):
+    return web.json_response({
+        'granted_token': {
+            'token': _random_id(),
+            'expires_after_seconds': 1209600,
+        },
+    })
+
+
+async def pathfinder(request):
+    data = await request.json()
+    variables = data['variables']
+    playlist_id = variables['uri'].split(':')[-1]
+    total = request.app['tracks']
+    offset = variables['offset']
+    end = min(total, offset + variables['limit'])
+    return web.json_response({'data': {'playlistV2': {
+        '__typename': 'Playlist',
+        'name': f'Radio {playlist_id}',
+        'description': 'Mock playlist',
+        'ownerV2': {'data': {'username': 'spotify'}},
+        'sharingInfo': {
+            'shareUrl': f'https://open.spotify.com/playlist/{playlist_id}',
+        },
+        'content': {
+            'totalCount': total,
+            'items': [
+                {'itemV2': {'data': {
+                    '__typename': 'Track',
+                    'uri': f'spotify:track:{playlist_id[:16]}{i:06d}',
+                }}}
+                for i in range(offset, end)
+            ],
+        },
+    }}})
+
+
+async def seed_to_playlist(request):
+    # Always map a seed to the same playlist, like Spotify does
+    seed_id = request.match_info['uri'].split(':')[-1]
+    playlist_id = uuid.uuid5(uuid.NAMESPACE_URL, seed_id).hex[:22]
+    return web.json_response({
+        'mediaItems': [{'uri': f'spotify:playlist:{playlist_id}'}],
+    })
+
+
+async def user_token(request):
+    return web.json_response({
+        'access_token': _random_id(),
+        'expires_in': 3600,
+        'refresh_token': 'mockrefresh',
+    })
+
+
+async def create_playlist(request):
+    playlist_id = _random_id()
+    request.app['playlists'][playlist_id] = 0
+    return web.json_response({
+        'id': playlist_id,
+        'external_urls': {
+            'spotify': f'https://open.spotify.com/playlist/{playlist_id}',
+        },
+    }, status=201)
+
+
+async def update_playlist(request):
+    return web.Response()
+
+
+async def get_items(request):
+    playlist_id = request.match_info['id']
+    return web.json_response({
+        'total': request.app['playlists'].get(playlist_id, 0),
+    })
+
+
+async def replace_items(request):
+    data = await request.json()
+    request.app['playlists'][request.match_info['id']] = len(data['uris'])
+    return web.json_response({'snapshot_id': _random_id()})
+
+
+async def add_items(request):
+    data = await request.json()
+    playlists = request.app['playlists']
+    playlist_id = request.match_info['id']
+    playlists[playlist_id] = (
+        playlists.get(playlist_id, 0) + len(data['uris']))
+    return web.json_response({'snapshot_id': _random_id()}, status=201)
+
+
+async def remove_playlists(request):
+    for uri in request.query.get('uris', '').split(','):
+        request.app['playlists'].pop(uri.split(':')[-1], None)
+    return web.Response()
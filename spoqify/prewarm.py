@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+
+from spoqify.utils import CountMinSketch
+
+
+class Prewarmer:
+    """Keep the results for the most popular URLs fresh.
+
+    Requests are counted per canonical key in a count-min sketch, and the
+    `top_n` most requested keys are tracked. While the job queue is mostly
+    idle, the hottest key whose result is missing or expires within `margin`
+    seconds is anonymized again, at most `rate` times per second.
+    """
+
+    def __init__(
+        self,
+        jobs,
+        top_n=100,
+        rate=.1,
+        margin=3600,
+        min_hits=3,
+        decay_interval=3600,
+    ):
+        self.jobs = jobs
+        self.top_n = top_n
+        self.rate = rate
+        self.margin = margin
+        self.min_hits = min_hits
+        self.decay_interval = decay_interval
+        self.sketch = CountMinSketch()
+        self.top = {}
+        self.attempts = {}
+        self.warmed = 0
+
+    def record(self, key):
+        if not self.top_n:
+            return
+        count = self.sketch.add(key)
+        if key in self.top or len(self.top) < self.top_n:
+            self.top[key] = count
+            return
+        coldest = min(self.top, key=self.top.get)
+        if count > self.top[coldest]:
+            del self.top[coldest]
+            self.top[key] = count
+
+    def decay(self):
+        self.sketch.decay()
+        self.top = {key: count // 2 for key, count in self.top.items()}
+        self.attempts = {
+            key: t for key, t in self.attempts.items() if key in self.top}
+
+    def candidates(self, expires):
+        """Yield keys that need warming, hottest first.
+
+        `expires` returns the expiry timestamp of the cached result for a
+        key (0 if there is none).
+        """
+        now = time.time()
+        for key, count in sorted(self.top.items(), key=lambda kv: -kv[1]):
+            if count < self.min_hits:
+                break
+            if key in self.jobs:
+                continue
+            last = self.attempts.get(key, -math.inf)
+            if time.monotonic() - last < self.margin:
+                continue
+            if expires(key) - now > self.margin:
+                continue
+            yield key
+
+    async def run(self, start_job, expires):
+        last_decay = time.monotonic()
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            if time.monotonic() - last_decay > self.decay_interval:
+                self.decay()
+                last_decay = time.monotonic()
+            if not self.jobs.is_idle():
+                continue
+            if (key := next(self.candidates(expires), None)) is None:
+                continue
+            self.attempts[key] = time.monotonic()
+            self.warmed += 1
+            start_job(key)
+
+    def stats(self):
+        return {
+            'tracked': len(self.top),
+            'warmed': self.warmed,
+        }
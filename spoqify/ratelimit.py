@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+
+
+class AdaptiveLimiter:
+    """Rate and concurrency limit for one class of upstream requests.
+
+    Requests are paced by a token bucket. Both its rate and the number of
+    concurrent requests are adjusted AIMD-style: the rate grows by 1% of its
+    initial value with every healthy response and the concurrency by one
+    every `limit` healthy responses, up to `max_growth` times their initial
+    values. Both are halved on 429 and 5xx responses. A 429 additionally
+    pauses the whole class for the duration of its `Retry-After` header,
+    including requests that are already queued.
+    """
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        concurrency=4,
+        min_concurrency=1,
+        max_concurrency=32,
+        max_growth=4,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.rate_step = rate / 100
+        self.min_rate = rate / 8
+        self.max_rate = rate * max_growth
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = min(max_concurrency, concurrency * max_growth)
+        self.in_flight = 0
+        self.throttled_until = 0
+        self.throttle_events = 0
+        self._waiters = collections.deque()
+        self._timer = None
+
+    async def acquire(self):
+        while True:
+            while (delay := self.throttled_until - time.time()) > 0:
+                await asyncio.sleep(delay)
+            await self._acquire_slot()
+            if self.throttled_until <= time.time():
+                break
+            # A 429 paused us while we were waiting for the slot
+            self.release()
+        try:
+            await self.bucket.acquire()
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    async def _acquire_slot(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were handed a slot but will not use it
+                self.release()
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def release(self, status=None, retry_after=None):
+        self.in_flight -= 1
+        if status is not None and (status == 429 or status >= 500):
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+            self.throttle_events += 1
+            if status == 429:
+                self.throttle(float(retry_after or 5))
+        elif status is not None and status < 400:
+            self.limit = min(
+                self.max_concurrency, self.limit + 1 / self.limit)
+            self.bucket.rate = min(
+                self.max_rate, self.bucket.rate + self.rate_step)
+        self._wake()
+
+    def throttle(self, delay):
+        self.throttled_until = max(self.throttled_until, time.time() + delay)
+
+    def _wake(self):
+        if (delay := self.throttled_until - time.time()) > 0:
+            # Hand out slots again once the pause is over
+            if self._timer is None and self._waiters:
+                self._timer = asyncio.get_running_loop().call_later(
+                    delay, self._wake_later)
+            return
+        while self._waiters and self.in_flight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                self.in_flight += 1
+
+    def _wake_later(self):
+        self._timer = None
+        self._wake()
+
+    def stats(self):
+        return {
+            'rate': round(self.bucket.rate, 2),
+            'concurrency': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': len(self._waiters),
+            'throttle_events': self.throttle_events,
+            'throttled_for': max(0, round(self.throttled_until - time.time())),
+        }
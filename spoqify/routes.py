@@ -1,67 +1,161 @@
 import asyncio
+import functools
+import math
 import re
 
 import quart
 
 import spoqify
+from spoqify import metrics, upstream
+from spoqify.admission import Overloaded
 from spoqify.app import app
 from spoqify.anonymization import (
     anonymize_from_seed,
     anonymize_playlist,
     Rejected,
 )
-
-
-api_worker_limit = asyncio.Semaphore(4)
+from spoqify.spotify import get_accounts
 
 
 def encode_event(event, data):
     return f"event: {event}\ndata: {data}\r\n\r\n".encode()
 
 
-async def limit(f, *args, **kwargs):
-    async with api_worker_limit:
-        return (await f(*args, **kwargs))
+def parse_url(url):
+    """Return a canonical `(kind, id)` key for the URL."""
+    if m := re.search(r'playlist[/:]([A-Za-z0-9]{22})\b', url):
+        return ('playlist', m.group(1))
+    elif m := re.search(r'(artist|album|track)[/:]([A-Za-z0-9]{22})\b', url):
+        return (m.group(1), m.group(2))
+    # Use best guess for 'abc123', 'abc123?si=xy' and 'abc123/station'
+    playlist_id = url.split('/')[0].split('?')[0]
+    if not re.match(r'[a-zA-Z0-9]{22}$', playlist_id):
+        raise ValueError("Invalid playlist ID")
+    return ('playlist', playlist_id)
 
 
-def _make_task(url):
-    app.logger.debug("Creating task for %s", url)
-    if m := re.search(r'playlist[/:]([A-Za-z0-9]{22})\b', url):
+def _make_job(key, refresh=False):
+    app.logger.debug("Creating job for spotify:%s:%s", *key)
+    kind, id_ = key
+    if kind == 'playlist':
         f = anonymize_playlist
         kwargs = {
-            'playlist_id': m.group(1),
-        }
-    elif m := re.search(r'(artist|album|track)[/:]([A-Za-z0-9]{22})\b', url):
-        f = anonymize_from_seed
-        kwargs = {
-            'seed_type': m.group(1),
-            'seed_id': m.group(2),
+            'playlist_id': id_,
+            'refresh': refresh,
         }
     else:
-        f = anonymize_playlist
-        # Use best guess for 'abc123', 'abc123?si=xy' and 'abc123/station'
-        playlist_id = url.split('/')[0].split('?')[0]
-        if not re.match(r'[a-zA-Z0-9]{22}$', playlist_id):
-            raise ValueError("Invalid playlist ID")
+        f = anonymize_from_seed
         kwargs = {
-            'playlist_id': playlist_id,
+            'seed_type': kind,
+            'seed_id': id_,
+            'refresh': refresh,
         }
-    return asyncio.create_task(limit(f, **kwargs))
+    job = app.jobs.add(
+        key,
+        functools.partial(_run_coalesced, key, f, kwargs),
+        wait=functools.partial(_wait_for_claim, key),
+    )
+    job.task.add_done_callback(
+        lambda _: app.logger.debug("Finished job for spotify:%s:%s", *key))
+    return job
+
+
+def _claim_outcome(key):
+    # Return the result another worker process published for `key`, if any
+    if outcome := app.state.outcome(key):
+        status, data = outcome
+        if status == 'done':
+            return data
+        elif status == 'rejected':
+            raise Rejected(data)
+        raise ValueError(data)
+    return None
+
 
+async def _wait_for_claim(key):
+    # Wait for another worker process before taking a job slot, so we don't
+    # hold one while it does the work
+    while app.state.claimed(key):
+        await asyncio.sleep(.5)
+    return _claim_outcome(key)
 
-def _get_task(url):
+
+async def _run_coalesced(key, f, kwargs):
+    # Let only one worker process work on the same key at a time, the others
+    # wait for its outcome
+    while not await app.state.claim(key):
+        if (result := _claim_outcome(key)) is not None:
+            return result
+        await asyncio.sleep(.5)
+    try:
+        result = await f(**kwargs)
+    except Rejected as e:
+        await app.state.release(key, ('rejected', str(e)))
+        raise
+    except Exception as e:
+        await app.state.release(key, ('failed', str(e)))
+        raise
+    except BaseException:
+        # Cancelled: drop the claim so a waiting worker takes over
+        await app.state.release(key, None)
+        raise
+    await app.state.release(key, ('done', result))
+    return result
+
+
+def _get_job(key):
     app.recent_reqs.record()
-    if url not in app.tasks:
-        app.tasks[url] = _make_task(url)
+    app.prewarmer.record(key)
+    if job := app.jobs.get(key):
+        app.logger.debug("Using existing job for spotify:%s:%s", *key)
+        return job
+    return _make_job(key)
 
-        def _remove_task(task):
-            app.tasks.pop(url, None)
-            app.logger.debug("Finished task for %s", url)
 
-        app.tasks[url].add_done_callback(_remove_task)
-    else:
-        app.logger.debug("Using existing task for %s", url)
-    return app.tasks[url]
+def _prewarm(key):
+    def log_result(task):
+        if not task.cancelled() and (e := task.exception()):
+            app.logger.info("Unable to prewarm spotify:%s:%s: %s", *key, e)
+
+    app.logger.debug("Prewarming spotify:%s:%s", *key)
+    _make_job(key, refresh=True).task.add_done_callback(log_result)
+
+
+def _result_expires(key):
+    # Only peek, so that checking candidates doesn't skew the cache stats
+    # or keep entries from being evicted
+    if app.rejected_urls.peek(key):
+        return math.inf
+    kind, id_ = key
+    if kind != 'playlist' and (id_ := app.radio_playlists.peek(key)) is None:
+        return 0
+    return app.results.expires(id_)
+
+
+@app.before_serving
+async def start_prewarmer():
+    if app.config['PREWARM_TOP_N']:
+        app.prewarm_task = asyncio.create_task(
+            app.prewarmer.run(_prewarm, _result_expires))
+
+
+@app.after_serving
+async def stop_prewarmer():
+    if task := getattr(app, 'prewarm_task', None):
+        task.cancel()
+
+
+def _cached_result(key):
+    # Answer cache hits right away instead of queueing them behind jobs
+    kind, id_ = key
+    if kind != 'playlist' and (id_ := app.radio_playlists.get(key)) is None:
+        return None
+    if result_url := app.results.get(id_):
+        app.logger.debug("Using cached result for spotify:%s:%s", *key)
+        app.recent_reqs.record()
+        app.recent_reqs.record('success')
+        app.prewarmer.record(key)
+    return result_url
 
 
 def _get_url():
@@ -69,86 +163,120 @@ def _get_url():
     return quart.request.args.get('url', quart.request.args.get('playlist'))
 
 
+def _client_ip():
+    # Only trust as many X-Forwarded-For entries as we have proxies
+    if n := app.config['PROXY_COUNT']:
+        forwarded = quart.request.headers.get('X-Forwarded-For', '')
+        hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()]
+        if hops:
+            return hops[-min(n, len(hops))]
+    return quart.request.remote_addr
+
+
+def _admit(key):
+    if key not in app.jobs:
+        # Don't start jobs that are bound to fail while Spotify is down
+        upstream.check_circuits()
+    return app.admission.admit(_client_ip(), key)
+
+
 @app.route('/redirect')
 async def redirect():
     url = _get_url()
     if not url:
         return quart.redirect('https://spoqify.com/')
-    if e := app.rejected_urls.get(url):
-        app.recent_reqs.record('cached')
+    try:
+        key = parse_url(url)
+    except ValueError as e:
         return quart.abort(400, str(e))
+    if result_url := _cached_result(key):
+        return quart.redirect(result_url)
+    try:
+        ticket = _admit(key)
+    except Overloaded as e:
+        app.recent_reqs.record('shed')
+        return str(e), 503, {'Retry-After': str(e.retry_after)}
+    if msg := app.rejected_urls.get(key):
+        app.recent_reqs.record('cached')
+        return quart.abort(400, msg)
     try:
-        task = _get_task(url)
-        result_url = await asyncio.shield(task)
+        with ticket:
+            job = _get_job(key)
+            result_url = await asyncio.shield(job.task)
     except (Rejected, ValueError) as e:
         if isinstance(e, Rejected):
-            app.rejected_urls[url] = e
+            app.rejected_urls[key] = str(e)
         return quart.abort(400, str(e))
+    except Overloaded as e:
+        # E.g. the circuit to Spotify opened while the job ran
+        app.recent_reqs.record('shed')
+        return str(e), 503, {'Retry-After': str(e.retry_after)}
     else:
-        # Allow Spotify's database to sync
-        await asyncio.sleep(3)
         return quart.redirect(result_url)
 
 
 @app.route('/anonymize')
 async def anonymize():
     url = _get_url()
-    response = await quart.make_response(
-        stream_task_status(url),
-        {
-            'Content-Type': 'text/event-stream',
-            'Cache-Control': 'no-cache',
-            'Transfer-Encoding': 'chunked',
-        },
-    )
+    headers = {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Transfer-Encoding': 'chunked',
+    }
+    try:
+        key = parse_url(url or '')
+        if result_url := _cached_result(key):
+            body = encode_event('done', result_url)
+        else:
+            body = stream_task_status(url, key, _admit(key))
+    except ValueError as e:
+        body = encode_event('error', str(e))
+    except Overloaded as e:
+        # Reply with an event rather than an error status, so the browser
+        # can show the message
+        app.recent_reqs.record('shed')
+        headers['Retry-After'] = str(e.retry_after)
+        body = encode_event('error', str(e))
+    response = await quart.make_response(body, headers)
     response.timeout = None
     return response
 
 
-async def stream_task_status(url):
-    if e := app.rejected_urls.get(url):
+async def stream_task_status(url, key, ticket):
+    with ticket:
+        async for event in _stream_task_status(url, key):
+            yield event
+
+
+async def _stream_task_status(url, key):
+    if msg := app.rejected_urls.get(key):
         # Most of our rejections are bots requesting the same URL over and
         # over, no need to bother Spotify every time
         app.recent_reqs.record('cached')
-        yield encode_event('error', str(e))
+        yield encode_event('error', msg)
         return
+    job = _get_job(key)
+    async for position in job.updates():
+        yield encode_event('queued', position)
     try:
-        task = _get_task(url)
-    except ValueError as e:
+        result_url = await asyncio.shield(job.task)
+    except Rejected as e:
+        app.logger.info("Rejected request for %s: %s", url, e)
+        app.rejected_urls[key] = str(e)
+        app.recent_reqs.record('rejected')
         yield encode_event('error', str(e))
-        return
-    while True:
-        if len(app.tasks) >= 5:
-            task_idx = len(app.tasks) - 1
-            yield encode_event('queued', task_idx)
-        try:
-            result_url = await asyncio.wait_for(asyncio.shield(task), 5)
-        except asyncio.TimeoutError:
-            try:
-                task_idx = list(app.tasks).index(url)
-            except ValueError:
-                task_idx = 0
-            yield encode_event('queued', task_idx)
-        except Rejected as e:
-            app.logger.info("Rejected request for %s: %s", url, e)
-            app.rejected_urls[url] = e
-            app.recent_reqs.record('rejected')
-            yield encode_event('error', str(e))
-            break
-        except Exception as e:
-            app.logger.error(
-                "Request for %s resulted in error: %s",
-                url, e,
-                exc_info=True,
-            )
-            app.recent_reqs.record('failed')
-            yield encode_event('error', str(e))
-            break
-        else:
-            app.logger.info("Anonymized %s: %s", url, result_url)
-            app.recent_reqs.record('success')
-            yield encode_event('done', result_url)
-            break
+    except Exception as e:
+        app.logger.error(
+            "Request for %s resulted in error: %s",
+            url, e,
+            exc_info=True,
+        )
+        app.recent_reqs.record('failed')
+        yield encode_event('error', str(e))
+    else:
+        app.logger.info("Anonymized %s: %s", url, result_url)
+        app.recent_reqs.record('success')
+        yield encode_event('done', result_url)
 
 
 @app.route('/anonymize/<playlist_id>')
@@ -176,14 +304,45 @@ async def spotify_urls(**kwargs):
 @app.route('/status')
 async def status():
     stats = app.recent_reqs.get()
+    accounts = {
+        name: account.stats() for name, account in get_accounts().items()
+    }
     return {
         'status': 'ok',
         'version': spoqify.__version__,
         'recent_stats': stats,
         'recent_requests': stats.get('request', 0),
+        'recent_windows': {
+            '1m': app.recent_reqs.get(60),
+            '1h': app.recent_reqs.get(3600),
+            '24h': stats,
+        },
+        'result_cache': app.results.stats(),
+        'rejection_cache': app.rejected_urls.stats(),
+        'radio_cache': app.radio_playlists.stats(),
+        'playlist_pool': sum(a['playlist_pool'] for a in accounts.values()),
+        'playlist_registry': sum(
+            a['playlist_registry'] for a in accounts.values()),
+        'accounts': accounts,
+        'rate_limits': upstream.stats(),
+        'connection_pools': upstream.pool_stats(),
+        'circuits': upstream.circuit_stats(),
+        'queue': app.jobs.stats(),
+        'admission': app.admission.stats(),
+        'prewarm': app.prewarmer.stats(),
     }
 
 
+@app.route('/metrics')
+async def prometheus_metrics():
+    # Metrics are per process, scrape every worker separately
+    metrics.queue_depth.set(len(app.jobs.waiting))
+    metrics.jobs_running.set(len(app.jobs) - len(app.jobs.waiting))
+    for kind, limiter in upstream.limiters.items():
+        metrics.upstream_in_flight.set(limiter.in_flight, kind=kind)
+    return metrics.render(), {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/')
 async def index():
     return quart.redirect('https://spoqify.com/')
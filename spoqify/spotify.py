@@ -1,52 +1,183 @@
 import asyncio
 import json
+import os
 import time
-from contextlib import suppress
+from contextlib import asynccontextmanager, suppress
 
 import aiohttp
 
+from spoqify import metrics, upstream
 from spoqify.app import app
+from spoqify.utils import RecentCounter, RefreshingValue, write_json_atomic
 
 
+# Maximum number of items the Web API accepts per call
+ITEMS_PER_CALL = 100
+
+# Refresh tokens this many seconds before they expire
+TOKEN_MARGIN = 300
+
 INIT_CMD = 'QUART_APP=spoqify.app:app python -m quart init'
 
 
-api_calls_allowed = asyncio.Event()
-api_calls_allowed.set()
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
 
 
 class AuthCache(dict):
 
-    PATH = app.config['AUTH_FILE_PATH']
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
 
-    def load(self, require_init=False):
+    async def load(self, require_init=False, reload=False):
+        if reload:
+            self.clear()
         if not self:
             with suppress(Exception):
-                with open(self.PATH) as f:
-                    self.update(json.load(f))
+                self.update(await asyncio.to_thread(_read_json, self.path))
             if not self and require_init:
                 raise SystemExit(f"Please run `{INIT_CMD}` first")
 
-    def store(self):
-        with open(self.PATH, 'w') as f:
-            json.dump(self, f)
+    async def store(self):
+        await asyncio.to_thread(write_json_atomic, self.path, dict(self))
+
+
+class JSONStore:
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.loaded = False
+
+    async def load(self, reload=False):
+        if reload:
+            self.clear()
+            self.loaded = False
+        if not self.loaded:
+            with suppress(Exception):
+                self.restore(await asyncio.to_thread(_read_json, self.path))
+            self.loaded = True
+
+    async def store(self):
+        # Write a copy, we may be modified while the thread runs
+        await asyncio.to_thread(write_json_atomic, self.path, self.copy())
+
+
+class PlaylistPool(JSONStore, list):
+    """Blank playlists created ahead of time, persisted across restarts."""
+
+    def restore(self, data):
+        self.extend(data)
+
+
+class PlaylistRegistry(JSONStore, dict):
+    """Playlists we have filled, with the time they were last used.
+
+    Only kept while recycling is enabled. It grows beyond the recycle limit
+    only while all its playlists are too young to be recycled, so none of
+    them are lost.
+    """
+
+    def restore(self, data):
+        self.update(data)
+
+    async def touch(self, playlist, used=None):
+        if not app.config['PLAYLIST_RECYCLE_LIMIT']:
+            return
+        self[playlist['id']] = {
+            'url': playlist['url'],
+            'used': time.time() if used is None else used,
+        }
+        await self.store()
+
+    def recyclable(self):
+        limit = app.config['PLAYLIST_RECYCLE_LIMIT']
+        if not limit or len(self) < limit:
+            return None
+        # Never recycle playlists whose URL may still be in the result cache
+        min_age = max(
+            app.config['PLAYLIST_RECYCLE_MIN_AGE'],
+            app.config['RESULT_CACHE_TTL'],
+        )
+        playlist_id = min(self, key=lambda k: self[k]['used'])
+        if self[playlist_id]['used'] > time.time() - min_age:
+            return None
+        return {'id': playlist_id, 'url': self[playlist_id]['url']}
+
+
+class Account:
+    """A Spotify user account that we own playlists with.
+
+    The default account keeps its data in the configured paths, additional
+    accounts registered via `init --account NAME` use the same paths with a
+    `.NAME` suffix.
+    """
+
+    def __init__(self, name=None):
+        self.name = name or 'default'
+        self.suffix = f'.{name}' if name else ''
+        self.cache = AuthCache(app.config['AUTH_FILE_PATH'] + self.suffix)
+        self.token = RefreshingValue(self._fetch_token, margin=TOKEN_MARGIN)
+        self.pool = PlaylistPool(
+            app.config['PLAYLIST_POOL_PATH'] + self.suffix)
+        self.pool_low = asyncio.Event()
+        self.registry = PlaylistRegistry(
+            app.config['PLAYLIST_REGISTRY_PATH'] + self.suffix)
+        self.in_flight = 0
+        self.throttles = RecentCounter(max_age=600)
 
+    @asynccontextmanager
+    async def locked(self):
+        """Load pool and registry and keep other workers from modifying them.
+        """
+        async with app.state.lock(f'playlists{self.suffix}'):
+            await self.pool.load(reload=app.state.shared)
+            await self.registry.load(reload=app.state.shared)
+            yield
 
-cache = AuthCache()
+    def is_logged_in(self):
+        return os.path.exists(self.cache.path)
 
+    def is_recycling(self):
+        return self.registry.recyclable() is not None
 
-async def get_token():
-    cache.load(require_init=True)
-    if cache.get('expires', 0) < time.time() - 300:
+    def pool_is_low(self):
+        return (
+            len(self.pool) < app.config['PLAYLIST_POOL_SIZE']
+            and not self.is_recycling()
+        )
+
+    def score(self):
+        """Lower is better when picking an account for the next playlist."""
+        return (
+            self.in_flight
+            + 10 * self.throttles.get().get('429', 0)
+            + len(self.registry) / 1000
+        )
+
+    async def _fetch_token(self):
+        # Hold the lock for the whole refresh so that concurrent refreshes,
+        # also from other workers, result in a single upstream request
+        async with app.state.lock(f'auth{self.suffix}'):
+            await self.cache.load(require_init=True, reload=app.state.shared)
+            if self.cache.get('expires', 0) - TOKEN_MARGIN <= time.time():
+                await self._refresh_token()
+            return self.cache['token'], self.cache['expires']
+
+    async def _refresh_token(self):
+        cache = self.cache
         if 'code' in cache:
-            app.logger.debug("Authenticating user with code")
+            app.logger.debug("Authenticating %s user with code", self.name)
             data = {
                 'grant_type': 'authorization_code',
-                'code': cache.pop('code'),
+                'code': cache['code'],
                 'redirect_uri': 'http://127.0.0.1:8808/',
             }
         elif 'refresh_token' in cache:
-            app.logger.debug("Authenticating user with refresh token")
+            app.logger.debug(
+                "Authenticating %s user with refresh token", self.name)
             data = {
                 'grant_type': 'refresh_token',
                 'refresh_token': cache['refresh_token'],
@@ -54,7 +185,9 @@ async def get_token():
         else:
             raise SystemExit(
                 f"Malconfigured auth data, please run `{INIT_CMD}`")
-        resp = await app.session.post(
+        resp = await upstream.request(
+            'accounts',
+            'POST',
             'https://accounts.spotify.com/api/token',
             data=data,
             auth=aiohttp.helpers.BasicAuth(
@@ -68,30 +201,114 @@ async def get_token():
         cache['expires'] = time.time() + data['expires_in']
         if 'refresh_token' in data:
             cache['refresh_token'] = data['refresh_token']
-        cache.store()
-    return cache['token']
+        # Codes can only be used once. Keep it until it worked, so that a
+        # failed request can be retried
+        cache.pop('code', None)
+        await cache.store()
+
+    async def expire_token(self, key='expires'):
+        async with app.state.lock(f'auth{self.suffix}'):
+            await self.cache.load(reload=app.state.shared)
+            self.cache[key] = 0
+            await self.cache.store()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'recent_429s': self.throttles.get().get('429', 0),
+            'playlist_pool': len(self.pool),
+            'playlist_registry': len(self.registry),
+        }
+
+
+accounts = {}
+
+
+def get_accounts():
+    if not accounts:
+        accounts['default'] = Account()
+        for name in app.config['ACCOUNTS']:
+            account = Account(name)
+            if not account.is_logged_in():
+                # Picking it for a playlist would fail every time
+                app.logger.warning(
+                    "Account %s is not logged in, run `%s --account %s`",
+                    name, INIT_CMD, name)
+                continue
+            accounts[name] = account
+    return accounts
+
+
+def get_account(name=None):
+    accounts = get_accounts()
+    if name is None:
+        return next(iter(accounts.values()))
+    return accounts[name]
+
+
+def pick_account():
+    return min(get_accounts().values(), key=Account.score)
+
+
+async def _fetch_client_token():
+    # Client credentials belong to our app, not to a user. We keep them with
+    # the first account's auth data
+    account = get_account()
+    cache = account.cache
+    async with app.state.lock(f'auth{account.suffix}'):
+        await cache.load(reload=app.state.shared)
+        if cache.get('client_expires', 0) - TOKEN_MARGIN <= time.time():
+            app.logger.debug("Authenticating client")
+            resp = await upstream.request(
+                'accounts',
+                'POST',
+                'https://accounts.spotify.com/api/token',
+                data={
+                    'grant_type': 'client_credentials',
+                },
+                auth=aiohttp.helpers.BasicAuth(
+                    app.config['SPOTIFY_CLIENT_ID'],
+                    app.config['SPOTIFY_CLIENT_SECRET'],
+                ),
+            )
+            async with resp:
+                data = await resp.json()
+            cache['client_token'] = data['access_token']
+            cache['client_expires'] = time.time() + data['expires_in']
+            await cache.store()
+        return cache['client_token'], cache['client_expires']
+
+
+client_token = RefreshingValue(_fetch_client_token, margin=TOKEN_MARGIN)
+
+
+async def get_token(account=None):
+    return await get_account(account).token.get()
 
 
 async def get_client_token():
-    cache.load()
-    if cache.get('client_expires', 0) < time.time() - 300:
-        app.logger.debug("Authenticating client")
-        resp = await app.session.post(
-            'https://accounts.spotify.com/api/token',
-            data={
-                'grant_type': 'client_credentials',
-            },
-            auth=aiohttp.helpers.BasicAuth(
-                app.config['SPOTIFY_CLIENT_ID'],
-                app.config['SPOTIFY_CLIENT_SECRET'],
-            ),
-        )
-        async with resp:
-            data = await resp.json()
-        cache['client_token'] = data['access_token']
-        cache['client_expires'] = time.time() + data['expires_in']
-        cache.store()
-    return cache['client_token']
+    return await client_token.get()
+
+
+@app.before_serving
+async def start_account_tasks():
+    # Fail right away rather than on the first request
+    if not get_account().is_logged_in():
+        raise SystemExit(f"Please run `{INIT_CMD}` first")
+    app.account_tasks = []
+    for account in get_accounts().values():
+        app.account_tasks.append(
+            asyncio.create_task(account.token.keep_fresh()))
+        if app.config['PLAYLIST_POOL_SIZE']:
+            account.pool_low.set()
+            app.account_tasks.append(
+                asyncio.create_task(refill_pool(account)))
+
+
+@app.after_serving
+async def stop_account_tasks():
+    for task in getattr(app, 'account_tasks', []):
+        task.cancel()
 
 
 async def call_api(
@@ -99,34 +316,46 @@ async def call_api(
     data=None,
     use_client_token=False,
     method=None,
+    account=None,
     **kwargs,
 ):
+    account = get_account(account)
     retry = 0
     while True:
-        await api_calls_allowed.wait()
+        account.in_flight += 1
         try:
             resp = await call_api_now(
                 endpoint,
                 data=data,
                 use_client_token=use_client_token,
                 method=method,
+                account=account.name,
                 **kwargs,
             )
             return resp
         except aiohttp.ClientResponseError as e:
             if e.status == 429:
-                api_calls_allowed.clear()
+                # The rate limit is shared between reads and writes of the
+                # same token. The limiter that saw the 429 has already paused
+                # itself
+                account.throttles.record('429')
                 delay = float(e.headers.get('Retry-After', 5))
+                for kind in ('api-read', 'api-write'):
+                    upstream.throttle(
+                        kind,
+                        delay,
+                        None if use_client_token else account.name,
+                    )
                 app.logger.warning("Got 429, will retry in %s seconds", delay)
-                await asyncio.sleep(delay)
-                api_calls_allowed.set()
             elif e.status == 401:
                 if use_client_token:
                     app.logger.warning("Got 401, forcing client token refresh")
-                    cache['client_expires'] = 0
+                    client_token.invalidate()
+                    await get_account().expire_token('client_expires')
                 else:
                     app.logger.warning("Got 401, forcing user token refresh")
-                    cache['expires'] = 0
+                    account.token.invalidate()
+                    await account.expire_token()
             elif e.status >= 500 and retry < 3:
                 delay = .6 * 2 ** retry
                 app.logger.warning(
@@ -140,6 +369,8 @@ async def call_api(
                 raise
         else:
             break
+        finally:
+            account.in_flight -= 1
 
 
 async def call_api_now(
@@ -147,24 +378,28 @@ async def call_api_now(
     data=None,
     use_client_token=False,
     method=None,
+    account=None,
     **kwargs,
 ):
     if use_client_token:
         token = await get_client_token()
     else:
-        token = await get_token()
+        account = get_account(account).name
+        token = await get_token(account)
     app.logger.debug(
         "Requesting %s with %s token",
         endpoint,
-        'client' if use_client_token else 'user',
+        'client' if use_client_token else f'{account} user',
     )
     if not method:
         method = 'GET' if data is None else 'POST'
-    resp = await app.session.request(
-        method=method,
-        url=f'https://api.spotify.com/v1/{endpoint}',
+    resp = await upstream.request(
+        'api-read' if method == 'GET' else 'api-write',
+        method,
+        f'https://api.spotify.com/v1/{endpoint}',
         json=data,
         headers={'Authorization': f'Bearer {token}'},
+        account=None if use_client_token else account,
         **kwargs,
     )
     async with resp:
@@ -173,20 +408,163 @@ async def call_api_now(
 
 
 async def create_playlist(title, description, tracks):
-    app.logger.debug("Creating new playlist '%s'", title)
+    playlist = await reserve_playlist()
+    return await fill_playlist(playlist, title, description, tracks)
+
+
+async def reserve_playlist():
+    account = pick_account()
+    async with account.locked():
+        if playlist := account.registry.recyclable():
+            app.logger.debug("Recycling playlist %s", playlist['id'])
+            # Mark as used right away so concurrent requests skip it
+            await account.registry.touch(playlist)
+        elif account.pool:
+            playlist = account.pool.pop(0)
+            await account.pool.store()
+            app.logger.debug(
+                "Took playlist %s from pool (%d left)",
+                playlist['id'], len(account.pool))
+        if account.pool_is_low():
+            account.pool_low.set()
+    if playlist is None:
+        playlist = await _create_blank_playlist(account)
+    playlist['account'] = account.name
+    return playlist
+
+
+async def _create_blank_playlist(account):
+    app.logger.debug("Creating new playlist for %s account", account.name)
     data = await call_api(
         'me/playlists',
         data={
-            'name': title,
-            'description': description,
+            'name': "Spoqify",
+            'description': "Anonymization in progress",
         },
+        account=account.name,
     )
-    playlist_id = data['id']
+    return {
+        'id': data['id'],
+        'url': data['external_urls']['spotify'],
+    }
+
+
+async def refill_pool(account):
+    while True:
+        await account.pool_low.wait()
+        while True:
+            # Leave the write rate limit to requests while they keep us busy
+            while not app.jobs.is_idle():
+                await asyncio.sleep(1)
+            async with account.locked():
+                if not account.pool_is_low():
+                    break
+            try:
+                playlist = await _create_blank_playlist(account)
+            except Exception as e:
+                app.logger.warning("Unable to refill playlist pool: %s", e)
+                await asyncio.sleep(60)
+            else:
+                async with account.locked():
+                    account.pool.append(playlist)
+                    await account.pool.store()
+        account.pool_low.clear()
+
+
+async def fill_playlist(playlist, title, description, tracks):
+    account = get_account(playlist['account'])
     app.logger.debug(
-        "Adding %d tracks to playlist '%s' (%s)",
-        len(tracks), title, playlist_id)
+        "Filling playlist %s with '%s' (%d tracks)",
+        playlist['id'], title, len(tracks))
+    with metrics.phase_seconds.time(phase='details'):
+        await call_api(
+            f'playlists/{playlist["id"]}',
+            data={
+                'name': title,
+                'description': description,
+            },
+            method='PUT',
+            account=account.name,
+        )
+    with metrics.phase_seconds.time(phase='insert'):
+        await add_tracks(playlist['id'], tracks, account=account.name)
+    async with account.locked():
+        await account.registry.touch(playlist)
+    return playlist['url']
+
+
+async def release_playlist(playlist):
+    account = get_account(playlist['account'])
+    async with account.locked():
+        if playlist['id'] in account.registry:
+            app.logger.debug(
+                "Releasing recycled playlist %s", playlist['id'])
+            await account.registry.touch(playlist, used=0)
+            return
+        if len(account.pool) < app.config['PLAYLIST_POOL_SIZE']:
+            app.logger.debug(
+                "Returning unused playlist %s to pool", playlist['id'])
+            account.pool.append({
+                'id': playlist['id'],
+                'url': playlist['url'],
+            })
+            await account.pool.store()
+            return
+    app.logger.debug("Deleting unused playlist %s", playlist['id'])
+    try:
+        await call_api(
+            'me/library',
+            method='DELETE',
+            params={'uris': f'spotify:playlist:{playlist["id"]}'},
+            account=account.name,
+        )
+    except Exception as e:
+        app.logger.warning(
+            "Unable to delete unused playlist %s: %s", playlist['id'], e)
+
+
+async def add_tracks(playlist_id, tracks, account=None):
+    # The first chunk replaces whatever a recycled playlist contained. The
+    # remaining chunks are sent one after another: Spotify rejects positional
+    # inserts beyond the current end of the playlist, so parallel requests
+    # could not guarantee the track order
+    uris = [f'spotify:track:{track_id}' for track_id in tracks]
     await call_api(
         f'playlists/{playlist_id}/items',
-        data={'uris': [f'spotify:track:{track_id}' for track_id in tracks]},
+        data={'uris': uris[:ITEMS_PER_CALL]},
+        method='PUT',
+        account=account,
     )
-    return data['external_urls']['spotify']
+    for start in range(ITEMS_PER_CALL, len(uris), ITEMS_PER_CALL):
+        await call_api(
+            f'playlists/{playlist_id}/items',
+            data={
+                'uris': uris[start:start + ITEMS_PER_CALL],
+                'position': start,
+            },
+            account=account,
+        )
+
+
+async def wait_until_ready(playlist, n_tracks, timeout=None):
+    """Wait until Spotify reports all tracks for the playlist."""
+    if timeout is None:
+        timeout = app.config['PLAYLIST_READY_TIMEOUT']
+    deadline = time.monotonic() + timeout
+    delay = .2
+    while True:
+        data = await call_api(
+            f'playlists/{playlist["id"]}/items',
+            params={'limit': 1, 'fields': 'total'},
+            account=playlist['account'],
+        )
+        # A recycled playlist may have held more tracks before
+        if data and data.get('total') == n_tracks:
+            return True
+        if time.monotonic() + delay > deadline:
+            app.logger.warning(
+                "Playlist %s not ready after %s seconds",
+                playlist['id'], timeout)
+            return False
+        await asyncio.sleep(delay)
+        delay *= 2
@@ -0,0 +1,592 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from spoqify.utils import ExpiringCache, RecentCounter
+
+
+logger = logging.getLogger('spoqify')
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS cache (
+        name TEXT, key TEXT, value TEXT, expires REAL, used REAL,
+        PRIMARY KEY (name, key));
+    CREATE INDEX IF NOT EXISTS cache_used ON cache (name, used);
+    CREATE TABLE IF NOT EXISTS counters (
+        kind TEXT, bucket INTEGER, count INTEGER,
+        PRIMARY KEY (kind, bucket));
+    CREATE TABLE IF NOT EXISTS vals (
+        name TEXT PRIMARY KEY, value TEXT, expires REAL);
+    CREATE TABLE IF NOT EXISTS claims (
+        key TEXT PRIMARY KEY, owner TEXT, expires REAL, outcome TEXT);
+'''
+
+
+def _connect(path, **kwargs):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, timeout=5, isolation_level=None, **kwargs)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def _load_key(key):
+    # JSON turns our tuple keys into lists
+    key = json.loads(key)
+    return tuple(key) if isinstance(key, list) else key
+
+
+class MemoryState:
+    """State that lives in this process only (the default).
+
+    Running several workers with this backend works, but each worker keeps
+    its own caches, stats, tokens and rate limits.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._locks = {}
+        self._values = {}
+
+    def cache(self, name, maxsize, ttl):
+        return ExpiringCache(maxsize=maxsize, ttl=ttl)
+
+    def counter(self):
+        return RecentCounter()
+
+    def lock(self, name):
+        return self._locks.setdefault(name, asyncio.Lock())
+
+    def get_value(self, name):
+        value, expires = self._values.get(name, (None, 0))
+        return value if expires > time.time() else None
+
+    def set_value(self, name, value, expires):
+        self._values[name] = (value, expires)
+
+    async def invalidate(self, name):
+        """Forget a value, e.g. a token that upstream no longer accepts."""
+        self._values.pop(name, None)
+
+    async def fetch_shared(self, name, fetch, margin=60):
+        return await fetch()
+
+    async def claim(self, key, ttl=300):
+        return True
+
+    async def release(self, key, outcome):
+        pass
+
+    def outcome(self, key):
+        return None
+
+    def claimed(self, key):
+        return False
+
+    def close(self):
+        pass
+
+
+def _prune(db, caches):
+    now = time.time()
+    db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+    db.execute('DELETE FROM vals WHERE expires <= ?', (now,))
+    db.execute(
+        'DELETE FROM counters WHERE bucket <= ?', (int(now // 60) - 1440,))
+    for name, cache in caches.items():
+        db.execute(
+            'DELETE FROM cache WHERE name = ? AND key IN ('
+            '  SELECT key FROM cache WHERE name = ?'
+            '  ORDER BY used DESC LIMIT -1 OFFSET ?)',
+            (name, name, cache.maxsize),
+        )
+
+
+class BatchWriter:
+    """Commit SQL statements in batches, in a thread off the event loop.
+
+    Statements are collected for `flush_interval` seconds and then committed
+    in one transaction. Every `EVICT_EVERY` batches, expired and surplus
+    entries of `caches` are deleted.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path, caches, flush_interval=1):
+        self.db = _connect(path, check_same_thread=False)
+        self.caches = caches
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flush = None
+        self._batches = 0
+        self._lock = threading.Lock()
+
+    def write(self, sql, params):
+        self._pending.append((sql, params))
+        if self._flush is None:
+            try:
+                self._flush = asyncio.ensure_future(self._flush_later())
+            except RuntimeError:
+                # No event loop (e.g. in a CLI command)
+                self.flush()
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            batch, self._pending = self._pending, []
+            await asyncio.to_thread(self._commit, batch)
+        finally:
+            self._flush = None
+            if self._pending:
+                self._flush = asyncio.ensure_future(self._flush_later())
+
+    def flush(self):
+        batch, self._pending = self._pending, []
+        self._commit(batch)
+
+    def _commit(self, batch):
+        with self._lock:
+            try:
+                self.db.execute('BEGIN')
+                for sql, params in batch:
+                    self.db.execute(sql, params)
+                self._batches += 1
+                if self._batches % self.EVICT_EVERY == 0:
+                    _prune(self.db, self.caches)
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                logger.exception("Unable to save %d state changes", len(batch))
+                if self.db.in_transaction:
+                    self.db.execute('ROLLBACK')
+
+    def close(self):
+        if self._flush is not None:
+            self._flush.cancel()
+        self.flush()
+        self.db.close()
+
+
+class SQLiteState(MemoryState):
+    """State shared between all workers on one host.
+
+    Everything is kept in a SQLite database in WAL mode. Locks are file locks
+    next to it. Reads are short and run on the event loop. Writes run off
+    it: most are committed in batches every `flush_interval` seconds, claims
+    and tokens fetched under a lock are written right away from a thread, as
+    other workers wait for them.
+    """
+
+    shared = True
+
+    # Seconds to keep values (e.g. throttles) we read from the database
+    READ_INTERVAL = 1
+
+    def __init__(self, path, flush_interval=.25):
+        super().__init__()
+        self.path = path
+        self.owner = uuid.uuid4().hex
+        self.db = _connect(path)
+        self.caches = {}
+        self.writer = BatchWriter(path, self.caches, flush_interval)
+        self.sync_db = _connect(path, check_same_thread=False)
+        self._sync_lock = threading.Lock()
+        self._read = {}
+
+    def cache(self, name, maxsize, ttl):
+        cache = self.caches[name] = SQLiteCache(
+            self, name, maxsize=maxsize, ttl=ttl)
+        return cache
+
+    def counter(self):
+        return SQLiteCounter(self)
+
+    def write(self, sql, params):
+        self.writer.write(sql, params)
+
+    async def _write_now(self, f):
+        # Waiting for the database lock must not block the event loop
+        def run():
+            with self._sync_lock:
+                return f(self.sync_db)
+
+        return await asyncio.to_thread(run)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name):
+        # The process-local lock saves us from polling against ourselves
+        async with super().lock(name):
+            path = os.path.join(os.path.dirname(self.path), f'{name}.lock')
+            with open(path, 'a') as f:
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        await asyncio.sleep(.05)
+                    else:
+                        break
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_value(self, name):
+        now = time.time()
+        value, expires, read = self._read.get(name, (None, 0, 0))
+        if now - read > self.READ_INTERVAL:
+            row = self.db.execute(
+                'SELECT value, expires FROM vals WHERE name = ?', (name,),
+            ).fetchone()
+            value, expires = (json.loads(row[0]), row[1]) if row else (None, 0)
+            self._read[name] = (value, expires, now)
+        return value if expires > now else None
+
+    def set_value(self, name, value, expires):
+        self._read[name] = (value, expires, time.time())
+        self.write(
+            'INSERT OR REPLACE INTO vals VALUES (?, ?, ?)',
+            (name, json.dumps(value), expires),
+        )
+
+    async def invalidate(self, name):
+        self._read.pop(name, None)
+        await self._write_now(lambda db: db.execute(
+            'DELETE FROM vals WHERE name = ?', (name,)))
+
+    async def fetch_shared(self, name, fetch, margin=60):
+        """Call `fetch` unless another worker has a fresh result for us."""
+        async with self.lock(name):
+            row = self.db.execute(
+                'SELECT value, expires FROM vals WHERE name = ?', (name,),
+            ).fetchone()
+            if row and row[1] - margin > time.time():
+                return json.loads(row[0]), row[1]
+            value, expires = await fetch()
+            # The next worker to get the lock needs to see it
+            await self._write_now(lambda db: db.execute(
+                'INSERT OR REPLACE INTO vals VALUES (?, ?, ?)',
+                (name, json.dumps(value), expires),
+            ))
+            self._read[name] = (value, expires, time.time())
+            return value, expires
+
+    async def claim(self, key, ttl=300):
+        """Try to become the worker responsible for `key`."""
+        key = json.dumps(key)
+
+        def claim(db):
+            now = time.time()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('DELETE FROM claims WHERE expires < ?', (now,))
+                cursor = db.execute(
+                    'INSERT OR IGNORE INTO claims VALUES (?, ?, ?, NULL)',
+                    (key, self.owner, now + ttl),
+                )
+            return cursor.rowcount == 1
+
+        return await self._write_now(claim)
+
+    def claimed(self, key):
+        """Whether another worker is still working on `key`."""
+        row = self.db.execute(
+            'SELECT 1 FROM claims WHERE key = ? AND owner != ? '
+            'AND expires > ? AND outcome IS NULL',
+            (json.dumps(key), self.owner, time.time()),
+        ).fetchone()
+        return row is not None
+
+    async def release(self, key, outcome, ttl=10):
+        """Publish the outcome for workers waiting on our claim.
+
+        Without an outcome the claim is dropped, so a waiting worker can
+        take over.
+        """
+        if outcome is None:
+            sql = 'DELETE FROM claims WHERE key = ? AND owner = ?'
+            params = (json.dumps(key), self.owner)
+        else:
+            sql = (
+                'UPDATE claims SET outcome = ?, expires = ? '
+                'WHERE key = ? AND owner = ?')
+            params = (json.dumps(outcome), time.time() + ttl,
+                      json.dumps(key), self.owner)
+        await self._write_now(lambda db: db.execute(sql, params))
+
+    def outcome(self, key):
+        row = self.db.execute(
+            'SELECT outcome FROM claims WHERE key = ? AND expires > ?',
+            (json.dumps(key), time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def close(self):
+        self.writer.close()
+        self.sync_db.close()
+        self.db.close()
+
+
+class SQLiteCache:
+    """ExpiringCache lookalike stored in SQLite."""
+
+    def __init__(self, state, name, maxsize=1000, ttl=86400):
+        self.state = state
+        self.db = state.db
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM cache WHERE name = ?', (self.name,),
+        ).fetchone()[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        now = time.time()
+        key = json.dumps(key)
+        row = self.db.execute(
+            'SELECT value, used FROM cache '
+            'WHERE name = ? AND key = ? AND expires > ?',
+            (self.name, key, now),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        if row[1] < now - 60:
+            self.state.write(
+                'UPDATE cache SET used = ? WHERE name = ? AND key = ?',
+                (now, self.name, key),
+            )
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        self.state.write(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+            (self.name, json.dumps(key), json.dumps(value), expires, now),
+        )
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.state.write(
+            'DELETE FROM cache WHERE name = ? AND key = ?',
+            (self.name, json.dumps(key)),
+        )
+        return value
+
+    def peek(self, key, default=None):
+        row = self.db.execute(
+            'SELECT value FROM cache '
+            'WHERE name = ? AND key = ? AND expires > ?',
+            (self.name, json.dumps(key), time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def expires(self, key):
+        row = self.db.execute(
+            'SELECT expires FROM cache WHERE name = ? AND key = ?',
+            (self.name, json.dumps(key)),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SQLiteCounter(RecentCounter):
+    """RecentCounter lookalike stored in SQLite."""
+
+    def __init__(self, state, max_age=86400, resolution=60):
+        super().__init__(max_age=max_age, resolution=resolution)
+        self.state = state
+
+    def record(self, kind='request'):
+        self.state.write(
+            'INSERT INTO counters VALUES (?, ?, 1) '
+            'ON CONFLICT (kind, bucket) DO UPDATE SET count = count + 1',
+            (kind, self._bucket()),
+        )
+
+    def get(self, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        max_age = min(max_age, self.max_age)
+        oldest = self._bucket(time.time() - max_age)
+        return dict(self.state.db.execute(
+            'SELECT kind, SUM(count) FROM counters WHERE bucket >= ? '
+            'GROUP BY kind',
+            (oldest,),
+        ).fetchall())
+
+
+class PersistentState(MemoryState):
+    """State kept in memory and saved to SQLite in the background.
+
+    Caches, counters and values survive restarts. On startup, at most
+    `warmup` of the most recently written entries per cache are loaded,
+    older ones are read on demand. Writes never wait for the disk: they are
+    committed in batches off the event loop every `flush_interval` seconds.
+    """
+
+    def __init__(self, path, warmup=10000, flush_interval=1):
+        super().__init__()
+        self.path = path
+        self.warmup = warmup
+        # One connection for the event loop (reads only) and one for the
+        # thread that commits our writes
+        self.db = _connect(path)
+        self.caches = {}
+        self.writer = BatchWriter(path, self.caches, flush_interval)
+        now = time.time()
+        for name, value, expires in self.db.execute(
+            'SELECT name, value, expires FROM vals WHERE expires > ?', (now,),
+        ):
+            self._values[name] = (json.loads(value), expires)
+
+    def cache(self, name, maxsize, ttl):
+        cache = self.caches[name] = PersistentCache(
+            self, name, maxsize=maxsize, ttl=ttl)
+        return cache
+
+    def counter(self):
+        return PersistentCounter(self)
+
+    def set_value(self, name, value, expires):
+        super().set_value(name, value, expires)
+        self.write(
+            'INSERT OR REPLACE INTO vals VALUES (?, ?, ?)',
+            (name, json.dumps(value), expires),
+        )
+
+    async def invalidate(self, name):
+        await super().invalidate(name)
+        self.write('DELETE FROM vals WHERE name = ?', (name,))
+
+    async def fetch_shared(self, name, fetch, margin=60):
+        """Call `fetch` unless we saved a fresh result before a restart."""
+        value, expires = self._values.get(name, (None, 0))
+        if expires - margin > time.time():
+            return value, expires
+        value, expires = await fetch()
+        self.set_value(name, value, expires)
+        return value, expires
+
+    def write(self, sql, params):
+        self.writer.write(sql, params)
+
+    def close(self):
+        self.writer.close()
+        self.db.close()
+
+
+class PersistentCache(ExpiringCache):
+    """ExpiringCache that is saved through a PersistentState."""
+
+    def __init__(self, state, name, maxsize=1000, ttl=86400):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.state = state
+        self.name = name
+        limit = min(maxsize, state.warmup)
+        rows = state.db.execute(
+            'SELECT key, value, expires FROM cache '
+            'WHERE name = ? AND expires > ? ORDER BY used DESC LIMIT ?',
+            (name, time.time(), limit),
+        ).fetchall()
+        for key, value, expires in reversed(rows):
+            self.data[_load_key(key)] = (json.loads(value), expires)
+        # Only look up misses in the database if it holds more than we loaded
+        self.complete = len(rows) < limit
+
+    def _fetch(self, key):
+        # Look up an entry that we did not load into memory on startup
+        if self.complete or key in self.data:
+            return None
+        return self.state.db.execute(
+            'SELECT value, expires FROM cache '
+            'WHERE name = ? AND key = ? AND expires > ?',
+            (self.name, json.dumps(key), time.time()),
+        ).fetchone()
+
+    def get(self, key, default=None):
+        if row := self._fetch(key):
+            super().set(key, json.loads(row[0]), row[1] - time.time())
+        return super().get(key, default)
+
+    def peek(self, key, default=None):
+        if row := self._fetch(key):
+            return json.loads(row[0])
+        return super().peek(key, default)
+
+    def set(self, key, value, ttl=None):
+        super().set(key, value, ttl)
+        _, expires = self.data[key]
+        self.state.write(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+            (self.name, json.dumps(key), json.dumps(value), expires,
+             time.time()),
+        )
+
+    def pop(self, key, default=None):
+        self.state.write(
+            'DELETE FROM cache WHERE name = ? AND key = ?',
+            (self.name, json.dumps(key)),
+        )
+        return super().pop(key, default)
+
+    def expires(self, key):
+        if row := self._fetch(key):
+            return row[1]
+        return super().expires(key)
+
+
+class PersistentCounter(RecentCounter):
+    """RecentCounter that is saved through a PersistentState."""
+
+    def __init__(self, state, max_age=86400, resolution=60):
+        super().__init__(max_age=max_age, resolution=resolution)
+        self.state = state
+        for kind, bucket, count in state.db.execute(
+            'SELECT kind, bucket, count FROM counters WHERE bucket > ?',
+            (self._bucket() - self.size,),
+        ):
+            stamps, counts = self.history.setdefault(
+                kind, ([0] * self.size, [0] * self.size))
+            stamps[bucket % self.size] = bucket
+            counts[bucket % self.size] = count
+
+    def record(self, kind='request'):
+        super().record(kind)
+        self.state.write(
+            'INSERT INTO counters VALUES (?, ?, 1) '
+            'ON CONFLICT (kind, bucket) DO UPDATE SET count = count + 1',
+            (kind, self._bucket()),
+        )
+
+
+def create_state(backend, path, warmup=10000):
+    if backend == 'memory':
+        return MemoryState()
+    elif backend == 'persistent':
+        return PersistentState(path, warmup=warmup)
+    elif backend == 'sqlite':
+        return SQLiteState(path)
+    raise ValueError(f"Unknown state backend '{backend}'")
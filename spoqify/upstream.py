@@ -0,0 +1,182 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from spoqify import metrics
+from spoqify.app import app
+from spoqify.circuit import CircuitBreaker
+from spoqify.ratelimit import AdaptiveLimiter
+
+
+limiters = {}
+
+
+def get_limiter(kind, account=None):
+    """Return the limiter for `kind`, separate per user account if given."""
+    name = f'{kind}:{account}' if account else kind
+    if (limiter := limiters.get(name)) is None:
+        limiter = limiters[name] = AdaptiveLimiter(
+            *app.config['RATE_LIMITS'][kind],
+            max_growth=app.config['RATE_LIMIT_GROWTH'],
+        )
+    return name, limiter
+
+
+for kind in app.config['RATE_LIMITS']:
+    get_limiter(kind)
+
+
+class HostPool:
+    """Session with its own connection pool for one upstream host."""
+
+    def __init__(self, host, limit, keepalive):
+        self.host = host
+        self.created = 0
+        self.reused = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.breaker = CircuitBreaker(
+            host,
+            threshold=app.config['CIRCUIT_FAILURES'],
+            reset_timeout=app.config['CIRCUIT_RESET_TIMEOUT'],
+        )
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self._queued_start)
+        trace.on_connection_queued_end.append(self._queued_end)
+        trace.on_connection_create_end.append(self._created)
+        trace.on_connection_reuseconn.append(self._reused)
+        self.connector = aiohttp.TCPConnector(
+            limit=limit,
+            ttl_dns_cache=app.config['UPSTREAM_DNS_TTL'],
+            keepalive_timeout=keepalive,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=self.connector,
+            raise_for_status=True,
+            timeout=aiohttp.ClientTimeout(
+                total=app.config['UPSTREAM_TIMEOUT'],
+                connect=app.config['UPSTREAM_CONNECT_TIMEOUT'],
+            ),
+            trace_configs=[trace],
+        )
+
+    async def _queued_start(self, session, ctx, params):
+        ctx.queued = time.monotonic()
+
+    async def _queued_end(self, session, ctx, params):
+        self.waits += 1
+        self.wait_time += time.monotonic() - ctx.queued
+
+    async def _created(self, session, ctx, params):
+        self.created += 1
+
+    async def _reused(self, session, ctx, params):
+        self.reused += 1
+
+    async def close(self):
+        await self.session.close()
+
+    def stats(self):
+        # aiohttp has no public API for the pool size
+        in_use = len(getattr(self.connector, '_acquired', ()))
+        idle = sum(map(len, getattr(self.connector, '_conns', {}).values()))
+        return {
+            'limit': self.connector.limit,
+            'open': in_use + idle,
+            'idle': idle,
+            'created': self.created,
+            'reused': self.reused,
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 3),
+        }
+
+
+def get_pool(url):
+    host = urlsplit(url).hostname
+    if (pool := app.sessions.get(host)) is None:
+        limit, keepalive = app.config['UPSTREAM_POOLS'].get(
+            host, app.config['UPSTREAM_DEFAULT_POOL'])
+        pool = app.sessions[host] = HostPool(host, limit, keepalive)
+    return pool
+
+
+async def request(kind, method, url, account=None, **kwargs):
+    """Send a request to Spotify, subject to the rate limits for `kind`.
+
+    Requests made on behalf of a user `account` have their own limits.
+    """
+    name, limiter = get_limiter(kind, account)
+    pool = get_pool(url)
+    if pool.breaker.state == 'open':
+        raise pool.breaker.error()
+    if shared_until := app.state.get_value(f'throttle:{name}'):
+        limiter.throttled_until = max(limiter.throttled_until, shared_until)
+    await limiter.acquire()
+    try:
+        # The circuit may have opened while we were waiting
+        pool.breaker.check()
+    except Exception:
+        limiter.release()
+        raise
+    status = retry_after = None
+    if base := app.config['UPSTREAM_URL']:
+        parts = urlsplit(url)
+        url = f'{base.rstrip("/")}/{parts.netloc}{parts.path or "/"}'
+        if parts.query:
+            url += f'?{parts.query}'
+    start = time.monotonic()
+    try:
+        resp = await pool.session.request(method, url, **kwargs)
+        status = resp.status
+        pool.breaker.success()
+        return resp
+    except aiohttp.ClientResponseError as e:
+        status = e.status
+        retry_after = e.headers.get('Retry-After') if e.headers else None
+        if status >= 500:
+            pool.breaker.failure()
+        else:
+            pool.breaker.success()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pool.breaker.failure()
+        raise
+    finally:
+        metrics.upstream_seconds.observe(
+            time.monotonic() - start,
+            kind=kind,
+            host=pool.host,
+            status=status or 'error',
+        )
+        limiter.release(status, retry_after)
+        if status == 429:
+            throttle(kind, 0, account)
+
+
+def throttle(kind, delay, account=None):
+    """Pause requests of `kind` for `delay` seconds in all workers."""
+    name, limiter = get_limiter(kind, account)
+    limiter.throttle(delay)
+    until = limiter.throttled_until
+    app.state.set_value(f'throttle:{name}', until, until)
+
+
+def stats():
+    return {kind: limiter.stats() for kind, limiter in limiters.items()}
+
+
+def check_circuits():
+    """Raise `CircuitOpen` if any upstream is currently failing."""
+    for pool in app.sessions.values():
+        if pool.breaker.state == 'open':
+            raise pool.breaker.error()
+
+
+def circuit_stats():
+    return {host: pool.breaker.stats() for host, pool in app.sessions.items()}
+
+
+def pool_stats():
+    return {host: pool.stats() for host, pool in app.sessions.items()}
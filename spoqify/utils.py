@@ -1,8 +1,17 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import tempfile
 import time
+from collections import OrderedDict
 from contextlib import suppress
 
 
+logger = logging.getLogger('spoqify')
+
+
 def load_dotenv():
     with suppress(FileNotFoundError):
         with open('.env') as f:
@@ -12,28 +21,218 @@ def load_dotenv():
                     os.environ.setdefault(*line.split('=', 1))
 
 
+def write_json_atomic(path, data):
+    """Write JSON to `path` so that readers never see a partial file."""
+    dirname = os.path.dirname(path) or '.'
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
 class RecentCounter:
+    """Count events per kind over a sliding window in constant memory.
+
+    Events are recorded into a ring of `max_age / resolution` time buckets,
+    so counts are exact up to the bucket resolution: a window includes every
+    bucket it overlaps, i.e. up to `resolution` seconds more than asked for.
+    """
 
-    def __init__(self, max_age=86400):
+    def __init__(self, max_age=86400, resolution=60):
         self.max_age = max_age
+        self.resolution = resolution
+        self.size = max_age // resolution
         self.history = {}
 
+    def _bucket(self, now=None):
+        return int((time.time() if now is None else now) // self.resolution)
+
     def record(self, kind='request'):
-        self.history.setdefault(kind, []).append(time.time())
-
-    def clean(self):
-        threshold = time.time() - self.max_age
-        for k in list(self.history):
-            for idx, x in enumerate(self.history[k]):
-                if x > threshold:
-                    break
-            else:
-                idx = len(self.history[k])
-            self.history[k] = self.history[k][idx:]
-
-    def get(self):
-        self.clean()
+        bucket = self._bucket()
+        ring = self.history.get(kind)
+        if ring is None:
+            ring = self.history[kind] = ([0] * self.size, [0] * self.size)
+        stamps, counts = ring
+        idx = bucket % self.size
+        if stamps[idx] != bucket:
+            stamps[idx] = bucket
+            counts[idx] = 0
+        counts[idx] += 1
+
+    def get(self, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        max_age = min(max_age, self.max_age)
+        oldest = self._bucket(time.time() - max_age)
         return {
-            k: len(v)
-            for k, v in self.history.items()
+            k: sum(
+                count
+                for stamp, count in zip(stamps, counts)
+                if stamp >= oldest
+            )
+            for k, (stamps, counts) in self.history.items()
         }
+
+
+class CountMinSketch:
+    """Approximate event counts per key in constant memory.
+
+    Estimates never undercount, and overcount by a small fraction of the
+    total for a `width` of a few thousand. Call `decay()` regularly to let
+    old events fade out.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(
+            repr(key).encode(), digest_size=4 * self.depth).digest()
+        for i in range(0, len(digest), 4):
+            yield int.from_bytes(digest[i:i + 4], 'little') % self.width
+
+    def add(self, key):
+        """Count an event for `key` and return the new estimate."""
+        estimate = None
+        for row, idx in zip(self.rows, self._indexes(key)):
+            row[idx] += 1
+            if estimate is None or row[idx] < estimate:
+                estimate = row[idx]
+        return estimate
+
+    def estimate(self, key):
+        return min(
+            row[idx] for row, idx in zip(self.rows, self._indexes(key)))
+
+    def decay(self):
+        for row in self.rows:
+            for idx, count in enumerate(row):
+                row[idx] = count // 2
+
+
+class ExpiringCache:
+    """Mapping with a per-entry time-to-live and LRU eviction."""
+
+    def __init__(self, maxsize=1000, ttl=86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires <= time.time():
+            del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self.data[key] = (value, expires)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value, _ = self.data.pop(key, (default, None))
+        return value
+
+    def peek(self, key, default=None):
+        """Like `get`, but without counting it or refreshing the entry."""
+        value, expires = self.data.get(key, (default, 0))
+        return value if expires > time.time() else default
+
+    def expires(self, key):
+        """Return when the entry for `key` expires, or 0 if there is none."""
+        return self.data.get(key, (None, 0))[1]
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class RefreshingValue:
+    """Cache the result of `fetch` until shortly before it expires.
+
+    `fetch` is a coroutine function returning a `(value, expires)` tuple, with
+    `expires` being a UNIX timestamp. Within `margin` seconds of expiry, the
+    cached value is still handed out while a refresh runs in the background.
+    Concurrent refreshes share a single call to `fetch`.
+    """
+
+    def __init__(self, fetch, margin=60):
+        self.fetch = fetch
+        self.margin = margin
+        self.value = None
+        self.expires = 0
+        self._refresh = None
+
+    async def get(self):
+        now = time.time()
+        if self.value is None or now >= self.expires:
+            return await self.refresh()
+        if now >= self.expires - self.margin:
+            self._start_refresh()
+        return self.value
+
+    async def refresh(self):
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self):
+        self.value = None
+        self.expires = 0
+
+    async def keep_fresh(self, retry=60):
+        """Refresh the value ahead of expiry, forever."""
+        while True:
+            await asyncio.sleep(
+                max(10, self.expires - self.margin - time.time()))
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Unable to refresh value: %r", e)
+                await asyncio.sleep(retry)
+
+    def _start_refresh(self):
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._do_refresh())
+            self._refresh.add_done_callback(self._log_failure)
+        return self._refresh
+
+    async def _do_refresh(self):
+        try:
+            self.value, self.expires = await self.fetch()
+            return self.value
+        finally:
+            self._refresh = None
+
+    def _log_failure(self, fut):
+        if not fut.cancelled() and fut.exception():
+            logger.warning("Unable to refresh value: %r", fut.exception())